@@ -0,0 +1,70 @@
+# greaseweazle/aio.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from greaseweazle.usb import Unit
+
+## AsyncUnit:
+## An asyncio counterpart to usb.Unit, so that many Greaseweazles can be
+## driven from one event loop. Each unit owns a single I/O thread, which
+## serialises its commands and blocks on its port (so no polling occurs),
+## while the event loop stays free to service other units.
+##
+## Unit information (major, minor, sample_freq, etc.) and the delay
+## properties may be read directly from an AsyncUnit.
+class AsyncUnit:
+
+    def __init__(self, unit, executor):
+        self.unit = unit
+        self._executor = executor
+
+    ## open:
+    ## Perform the Unit handshake on the given port without blocking the
+    ## event loop, and return a new AsyncUnit.
+    @classmethod
+    async def open(cls, ser):
+        executor = ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        try:
+            unit = await loop.run_in_executor(executor, Unit, ser)
+        except:
+            executor.shutdown(wait=False)
+            raise
+        return cls(unit, executor)
+
+    ## close:
+    ## Release the unit's I/O thread.
+    def close(self):
+        self._executor.shutdown()
+
+    def __getattr__(self, name):
+        return getattr(self.unit, name)
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def seek(self, cyl, side):
+        await self._call(self.unit.seek, cyl, side)
+
+    async def drive_select(self, state):
+        await self._call(self.unit.drive_select, state)
+
+    async def drive_motor(self, state):
+        await self._call(self.unit.drive_motor, state)
+
+    async def read_track(self, nr_revs, nr_retries=5):
+        return await self._call(self.unit.read_track, nr_revs, nr_retries)
+
+    async def write_track(self, flux_list, nr_retries=5):
+        await self._call(self.unit.write_track, flux_list, nr_retries)
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -5,9 +5,15 @@
 # This is free and unencumbered software released into the public domain.
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
-import binascii
+import binascii, copy, itertools
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
 from bitarray import bitarray
 
+from greaseweazle.flux import Flux
+
 class Bitcell:
 
     def __init__(self):
@@ -15,6 +21,11 @@ class Bitcell:
         self.clock_max_adj = 0.10
         self.pll_period_adj = 0.05
         self.pll_phase_adj = 0.60
+        # Bitcell times (seconds) are collected as arrays of float32, or
+        # else are not collected (None) if only the bits are needed.
+        self.collect_times = True
+        # Clock-recovery engine (see below).
+        self.engine = PLL()
 
     def __str__(self):
         s = ""
@@ -26,23 +37,52 @@ class Bitcell:
         return s[:-1]
 
     def read_flux(self, flux):
+        # Per-revolution list of bitcells and bitcell times.
+        self.revolution_list = list(self.read_revolutions(flux))
+
+    # read_revolutions:
+    # Generator which decodes the given flux lazily, yielding (bits, times)
+    # for each revolution in turn. Clock-recovery state is kept between
+    # revolutions, so a caller may stop as soon as it has found what it
+    # needs, and the flux beyond that point is never decoded.
+    def read_revolutions(self, flux):
+        return self.engine.read_revolutions(self, flux)
+
+
+# Clock-recovery engines:
+# An engine decodes flux into bitcells for a Bitcell object, which holds
+# the nominal clock and (for the PLL engines) the PLL parameters. Its
+# read_revolutions(bitcell, flux) method is a generator, as described
+# for Bitcell.read_revolutions.
+
+
+# PLL: The default engine. A phase-locked loop around the nominal clock.
+class PLL:
+
+    def read_revolutions(self, bitcell, flux):
+        return self._read_revolutions(bitcell, flux, bitcell.clock)
+
+    def _read_revolutions(self, bitcell, flux, centre):
 
         index_list, freq = flux.index_list, flux.sample_freq
 
-        clock = self.clock
-        clock_min = self.clock * (1 - self.clock_max_adj)
-        clock_max = self.clock * (1 + self.clock_max_adj)
+        clock = centre
+        clock_min = centre * (1 - bitcell.clock_max_adj)
+        clock_max = centre * (1 + bitcell.clock_max_adj)
         ticks = 0.0
 
-        # Per-revolution list of bitcells and bitcell times.
-        self.revolution_list = []
-
         # Initialise bitcell lists for the first revolution.
-        bits, times = bitarray(), []
-        to_index = index_list[0] / freq
-        index_list = index_list[1:]
+        new_times = lambda: array('f') if bitcell.collect_times else None
+        bits, times = bitarray(), new_times()
+        index_list = iter(index_list)
+        to_index = next(index_list) / freq
+
+        # Flux samples are converted for the loop a chunk at a time.
+        samples = itertools.chain.from_iterable(
+            flux.list[i:i+4096].tolist()
+            for i in range(0, len(flux.list), 4096))
 
-        for x in flux.list:
+        for x in samples:
 
             # Gather enough ticks to generate at least one bitcell.
             ticks += x / freq
@@ -56,15 +96,16 @@ class Bitcell:
                 # Check if we cross the index mark.
                 to_index -= clock
                 if to_index < 0:
-                    self.revolution_list.append((bits, times))
-                    if not index_list:
+                    yield bits, times
+                    to_index = next(index_list, None)
+                    if to_index is None:
                         return
-                    bits, times = bitarray(), []
-                    to_index = index_list[0] / freq
-                    index_list = index_list[1:]
+                    bits, times = bitarray(), new_times()
+                    to_index /= freq
 
                 ticks -= clock
-                times.append(clock)
+                if times is not None:
+                    times.append(clock)
                 if ticks >= clock/2:
                     zeros += 1
                     bits.append(False)
@@ -75,18 +116,130 @@ class Bitcell:
             # PLL: Adjust clock frequency according to phase mismatch.
             if zeros <= 3:
                 # In sync: adjust clock by a fraction of the phase mismatch.
-                clock += ticks * self.pll_period_adj
+                clock += ticks * bitcell.pll_period_adj
             else:
                 # Out of sync: adjust clock towards centre.
-                clock += (self.clock - clock) * self.pll_period_adj
+                clock += (centre - clock) * bitcell.pll_period_adj
             # Clamp the clock's adjustment range.
             clock = min(max(clock, clock_min), clock_max)
             # PLL: Adjust clock phase according to mismatch.
-            new_ticks = ticks * (1 - self.pll_phase_adj)
-            times[-1] += ticks - new_ticks
+            new_ticks = ticks * (1 - bitcell.pll_phase_adj)
+            if times is not None:
+                times[-1] += ticks - new_ticks
             ticks = new_ticks
 
-        self.revolution_list.append((bits, times))
+        yield bits, times
+
+
+# AdaptivePLL: A PLL whose centre clock is measured from the flux, rather
+# than being the nominal clock. The shortest flux intervals are
+# histogrammed, and their peak is taken to be @cells bitcells long (2 for
+# MFM).
+class AdaptivePLL(PLL):
+
+    def __init__(self, cells=2):
+        self.cells = cells
+
+    def read_revolutions(self, bitcell, flux):
+        clock = self.estimate_clock(flux, bitcell.clock)
+        return self._read_revolutions(bitcell, flux, clock)
+
+    # estimate_clock:
+    # Returns the measured clock, or @default if there is no flux to measure.
+    def estimate_clock(self, flux, default):
+        x = flux.list / flux.sample_freq
+        if not len(x):
+            return default
+        short = x[x <= np.percentile(x, 5) * 1.4]
+        if short.min() == short.max():
+            # All the same length: There is no histogram to speak of.
+            clock = short[0] / self.cells
+        else:
+            hist, edges = np.histogram(short, bins=64)
+            i = int(np.argmax(hist))
+            clock = (edges[i] + edges[i+1]) / 2 / self.cells
+        return clock if clock > 0 else default
+
+
+# FixedClock: Quantizes flux to the nominal clock, with no tracking of
+# speed variation. Each flux transition falls in the bitcell nearest to
+# it in time, and revolutions are split at the index times. Fast, since
+# it is vectorised, but only tolerates small clock errors.
+class FixedClock:
+
+    def read_revolutions(self, bitcell, flux):
+        freq, clock = flux.sample_freq, bitcell.clock
+        # Bitcell of each flux transition: transitions less than half a
+        # bitcell apart are merged, as in the PLL.
+        time = np.cumsum(flux.list, dtype=np.int64) / freq
+        ones = np.unique(np.rint(time / clock).astype(np.int64) - 1)
+        ones = ones[ones >= 0]
+        total = int(ones[-1]) + 1 if len(ones) else 0
+        cells = np.zeros(total, dtype=np.uint8)
+        cells[ones] = 1
+        # Revolution boundaries, in bitcells.
+        index = np.cumsum(flux.index_list, dtype=np.int64) / freq
+        ends = (index / clock).astype(np.int64).tolist()
+        start = 0
+        for end in ends:
+            bits = bitarray()
+            bits.pack(cells[start:min(end, total)].tobytes())
+            times = None
+            if bitcell.collect_times:
+                times = array('f', [clock]) * len(bits)
+            yield bits, times
+            if end >= total:
+                return
+            start = end
+
+
+# read_flux_list:
+# Decodes each of the given Flux objects with a copy of @bitcell (default:
+# a new Bitcell), in parallel across @workers processes (default: one per
+# CPU). Returns the list of decoded Bitcell objects, in the same order.
+# Flux samples are passed to the workers in a shared-memory block.
+def read_flux_list(flux_list, bitcell=None, workers=None):
+    if bitcell is None:
+        bitcell = Bitcell()
+    if not flux_list:
+        return []
+    ends = np.cumsum([len(flux.list) for flux in flux_list])
+    shm = shared_memory.SharedMemory(create=True, size=max(4*int(ends[-1]), 1))
+    try:
+        samples = np.ndarray((ends[-1],), dtype=np.uint32, buffer=shm.buf)
+        jobs, start = [], 0
+        with ProcessPoolExecutor(workers) as executor:
+            for flux, end in zip(flux_list, ends.tolist()):
+                samples[start:end] = flux.list
+                jobs.append(executor.submit(
+                    _read_flux_shared, bitcell, shm.name, start, end,
+                    flux.index_list, flux.sample_freq))
+                start = end
+            result = []
+            for job in jobs:
+                b = copy.copy(bitcell)
+                b.revolution_list = job.result()
+                result.append(b)
+        del samples
+    finally:
+        shm.close()
+        shm.unlink()
+    return result
+
+
+# _read_flux_shared:
+# Worker for read_flux_list: Decodes the flux samples at [start:end] of the
+# named shared-memory block, and returns the revolution list.
+def _read_flux_shared(bitcell, name, start, end, index_list, sample_freq):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        samples = np.ndarray((end-start,), dtype=np.uint32,
+                             buffer=shm.buf, offset=4*start)
+        bitcell.read_flux(Flux(index_list, samples, sample_freq))
+        del samples
+    finally:
+        shm.close()
+    return bitcell.revolution_list
 
 # Local variables:
 # python-indent: 4
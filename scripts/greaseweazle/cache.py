@@ -0,0 +1,87 @@
+# greaseweazle/cache.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import os, time, hashlib
+
+## StreamCache:
+## An on-disk cache of encoded Greaseweazle data streams, so that an image
+## which is written repeatedly need be converted only once. Any repr()-able
+## tuple may be used as a key. Each entry is stored in its own file in the
+## cache directory, and the least recently used entries are evicted when
+## the total size of the cache exceeds @max_size bytes.
+class StreamCache:
+
+    suffix = ".gwstream"
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        # Index the existing entries: name -> [last use, size].
+        self.index = dict()
+        for e in os.scandir(path):
+            if e.name.endswith(self.suffix):
+                st = e.stat()
+                self.index[e.name] = [st.st_mtime, st.st_size]
+        self.size = sum(size for _, size in self.index.values())
+
+    def _name(self, key):
+        return hashlib.sha256(repr(key).encode()).hexdigest() + self.suffix
+
+    ## get:
+    ## Returns the data stream for the given key, or None if it is not cached.
+    def get(self, key):
+        name = self._name(key)
+        filename = os.path.join(self.path, name)
+        try:
+            with open(filename, "rb") as f:
+                dat = f.read()
+            # Record the use in the file's timestamp, for future runs.
+            now = time.time()
+            os.utime(filename, (now, now))
+        except FileNotFoundError:
+            self.index.pop(name, None)
+            self.misses += 1
+            return None
+        self.index[name] = [now, len(dat)]
+        self.hits += 1
+        return dat
+
+    ## put:
+    ## Stores the data stream for the given key, evicting old entries if
+    ## the cache becomes too large.
+    def put(self, key, dat):
+        name = self._name(key)
+        filename = os.path.join(self.path, name)
+        # Write via a temporary file, so that concurrent users of the cache
+        # never see a partial entry.
+        tmp = "%s.%u.tmp" % (filename, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(dat)
+        os.replace(tmp, filename)
+        old = self.index.get(name)
+        self.size += len(dat) - (old[1] if old else 0)
+        self.index[name] = [time.time(), len(dat)]
+        self._evict()
+
+    def _evict(self):
+        if self.size <= self.max_size:
+            return
+        for name in sorted(self.index, key=lambda n: self.index[n][0]):
+            if self.size <= self.max_size:
+                break
+            _, size = self.index.pop(name)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -5,12 +5,20 @@
 # This is free and unencumbered software released into the public domain.
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
+import numpy as np
+
 class Flux:
 
+    __slots__ = ('index_list', 'list', 'sample_freq', '_time')
+
     def __init__(self, index_list, flux_list, sample_freq):
         self.index_list = index_list
-        self.list = flux_list
+        # The samples are copied, so that clip() cannot modify the caller's
+        # array.
+        self.list = np.array(flux_list, dtype=np.uint32)
         self.sample_freq = sample_freq
+        # Running total of flux time at the end of each sample.
+        self._time = np.cumsum(self.list, dtype=np.int64)
 
     def __str__(self):
         s = "Sample Frequency: %f MHz\n" % (self.sample_freq/1000000)
@@ -21,6 +29,42 @@ class Flux:
             rev += 1
         return s[:-1]
 
+    # sample_at:
+    # Returns the index of the flux sample which is in progress at the
+    # specified time (in ticks since the start of the flux list). A sample
+    # which ends exactly at that time is complete, and so is not returned.
+    def sample_at(self, ticks):
+        return int(np.searchsorted(self._time, ticks, side='right'))
+
+    # clip:
+    # Discards the flux before the specified time (in ticks since the start
+    # of the flux list). The sample in progress at that time is shortened
+    # to start there.
+    def clip(self, ticks):
+        i = self.sample_at(ticks)
+        self.list, self._time = self.list[i:], self._time[i:] - ticks
+        if len(self.list):
+            self.list[0] = self._time[0]
+
+    # resample:
+    # Returns the flux samples scaled by the specified factor (for example,
+    # the ratio of a target sample frequency to this one). Sample
+    # boundaries are rounded to the nearest target tick, so rounding errors
+    # do not accumulate and total track time is preserved.
+    def resample(self, factor):
+        time = np.rint(self._time * factor).astype(np.int64)
+        return np.diff(time, prepend=0).astype(np.uint32)
+
+    # revolution:
+    # Returns a view (not a copy) of the flux samples in the specified
+    # index-to-index revolution. A sample which crosses an index mark
+    # belongs to the revolution in which it ends.
+    def revolution(self, rev):
+        start = sum(self.index_list[:rev])
+        end = start + self.index_list[rev]
+        s = self.sample_at(start) if rev else 0
+        return self.list[s:self.sample_at(end)]
+
 # Local variables:
 # python-indent: 4
 # End:
@@ -20,6 +20,13 @@ class HFE:
         return hfe
 
 
+    @classmethod
+    def to_file(cls, f, start_cyl, nr_sides):
+        hfe = cls(start_cyl, nr_sides)
+        hfe._f = f
+        return hfe
+
+
     def get_track(self, cyl, side, writeout=False):
         return None
     
@@ -32,6 +39,10 @@ class HFE:
         return bytes()
 
 
+    def close(self):
+        self._f.write(self.get_image())
+
+
 # Local variables:
 # python-indent: 4
 # End:
@@ -6,9 +6,17 @@
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
 import struct
+import numpy as np
 
 from greaseweazle.flux import Flux
 
+# checksum:
+# Returns the sum of all the bytes in the given bytes-like object, as used
+# for the SCP image checksum (which is this sum, modulo 2^32).
+def checksum(dat):
+    return int(np.frombuffer(dat, dtype=np.uint8).sum(dtype=np.uint64))
+
+
 class SCP:
 
     # 40MHz
@@ -19,13 +27,22 @@ class SCP:
         self.nr_sides = nr_sides
         self.nr_revs = None
         self.track_list = []
+        self._f = None
+        # Sum of the bytes of all appended tracks, kept as they are added.
+        self._csum = 0
 
 
+    # from_file:
+    # Parses an SCP image from a bytes-like object, such as a memory-mapped
+    # file. Only the image header and track offset table are parsed here:
+    # each track is parsed on first use, as views of @dat, so that using a
+    # few tracks of a large image does not touch the rest of it.
     @classmethod
     def from_file(cls, dat):
 
+        dat = memoryview(dat)
         header = struct.unpack("<3s9BI", dat[0:16])
-        (sig, _, _, nr_revs, s_trk, e_trk, flags, _, ss, _, _) = header
+        (sig, _, _, nr_revs, s_trk, e_trk, flags, _, ss, _, csum) = header
         assert sig == b"SCP"
         nr_sides = 1 if ss else 2
         
@@ -33,25 +50,56 @@ class SCP:
 
         scp = cls(s_trk // nr_sides, nr_sides)
         scp.nr_revs = nr_revs
+        scp.checksum = csum
+        scp._dat, scp._s_trk = dat, s_trk
+        scp._trk_offs = trk_offs[s_trk:e_trk+1]
+        scp.track_list = [None] * len(scp._trk_offs)
+        scp._csum = None
 
-        for trknr in range(s_trk, e_trk+1):
-            trk_off = trk_offs[trknr]
-            if trk_off == 0:
-                scp.track_list.append((None, None))
+        return scp
 
-            # Parse the SCP track header and extract the flux data.
-            thdr = dat[trk_off:trk_off+4+12*nr_revs]
-            sig, tnr, _, _, s_off = struct.unpack("<3sB3I", thdr[:16])
-            assert sig == b"TRK"
-            assert tnr == trknr
-            _, e_nr, e_off = struct.unpack("<3I", thdr[-12:])
-            tdat = dat[trk_off+s_off:trk_off+e_off+e_nr*2]
 
-            scp.track_list.append((thdr, tdat))
+    # checksum_ok:
+    # Validates an image parsed by from_file() against the checksum in its
+    # image header. This reads the entire image.
+    def checksum_ok(self):
+        return (checksum(self._dat[16:]) & 0xffffffff) == self.checksum
 
+
+    # to_file:
+    # Returns a new SCP image which is written to the given file (opened
+    # for binary writing) as it is built. Space is reserved for the image
+    # header and track offset table, and each appended track is written to
+    # the file immediately, rather than being held in memory until
+    # get_image(). The header and offsets are filled in by close().
+    @classmethod
+    def to_file(cls, f, start_cyl, nr_sides):
+        scp = cls(start_cyl, nr_sides)
+        scp._f = f
+        scp._trk_offs, scp._trk_end = [], 0x2b0
+        f.write(bytes(scp._trk_end))
         return scp
 
 
+    # _parse_track:
+    # Parses the SCP track header of the given entry in the track list, and
+    # extracts the flux data.
+    def _parse_track(self, off):
+        trknr = self._s_trk + off
+        trk_off = self._trk_offs[off]
+        if trk_off == 0:
+            self.track_list[off] = (None, None)
+            return
+        dat, nr_revs = self._dat, self.nr_revs
+        thdr = dat[trk_off:trk_off+4+12*nr_revs]
+        sig, tnr, _, _, s_off = struct.unpack("<3sB3I", thdr[:16])
+        assert sig == b"TRK"
+        assert tnr == trknr
+        _, e_nr, e_off = struct.unpack("<3I", thdr[-12:])
+        tdat = dat[trk_off+s_off:trk_off+e_off+e_nr*2]
+        self.track_list[off] = (thdr, tdat)
+
+
     def get_track(self, cyl, side, writeout=False):
         if side >= self.nr_sides:
             return None
@@ -60,6 +108,8 @@ class SCP:
         off = (cyl - self.start_cyl) * self.nr_sides + side
         if off >= len(self.track_list):
             return None
+        if self.track_list[off] is None:
+            self._parse_track(off)
         tdh, dat = self.track_list[off]
         if not dat:
             return None
@@ -77,16 +127,12 @@ class SCP:
             index_list.append(ticks)
             tdh = tdh[12:]
         
-        # Decode the SCP flux data into a simple list of flux times.
-        flux_list = []
-        val = 0
-        for i in range(0, len(dat), 2):
-            x = dat[i]*256 + dat[i+1]
-            if x == 0:
-                val += 65536
-                continue
-            flux_list.append(val + x)
-            val = 0
+        # Decode the SCP flux data into a simple list of flux times. Each
+        # zero-valued cell adds 65536 to the next non-zero cell.
+        cells = np.frombuffer(dat, dtype='>u2')
+        nz = np.flatnonzero(cells)
+        overflows = np.diff(nz, prepend=-1) - 1
+        flux_list = cells[nz] + (overflows.astype(np.uint32) << 16)
 
         return Flux(index_list, flux_list, SCP.sample_freq)
     
@@ -103,57 +149,62 @@ class SCP:
             assert self.nr_revs == nr_revs
         
         factor = SCP.sample_freq / flux.sample_freq
+        flux_list = flux.resample(factor).astype(np.int64)
 
-        trknr = self.start_cyl * self.nr_sides + len(self.track_list)
+        nr_tracks = len(self.track_list if self._f is None
+                        else self._trk_offs)
+        trknr = self.start_cyl * self.nr_sides + nr_tracks
         tdh = struct.pack("<3sB", b"TRK", trknr)
-        dat = bytearray()
-
-        len_at_index = rev = 0
-        to_index = flux.index_list[0]
-        rem = 0.0
-
-        for x in flux.list:
-
-            # Does the next flux interval cross the index mark?
-            while to_index < x:
-                # Append to the TDH for the previous full revolution
-                tdh += struct.pack("<III",
-                                   int(round(flux.index_list[rev]*factor)),
-                                   (len(dat) - len_at_index) // 2,
-                                   4 + nr_revs*12 + len_at_index)
-                # Set up for the next revolution
-                len_at_index = len(dat)
-                rev += 1
-                if rev >= nr_revs:
-                    # We're done: We simply discard any surplus flux samples
-                    self.track_list.append((tdh, dat))
-                    return
-                to_index += flux.index_list[rev]
-
-            # Process the current flux sample into SCP "bitcell" format
-            to_index -= x
-            y = x * factor + rem
-            val = int(round(y))
-            if (val & 65535) == 0:
-                val += 1
-            rem = y - val
-            while val >= 65536:
-                dat.append(0)
-                dat.append(0)
-                val -= 65536
-            dat.append(val>>8)
-            dat.append(val&255)
-
-        # Header for last track(s) in case we ran out of flux timings.
-        while rev < nr_revs:
+
+        # Sample index at the end of each full revolution. Any surplus flux
+        # samples beyond the final revolution are simply discarded.
+        to_index, ends = 0, []
+        for rev in range(nr_revs):
+            to_index += flux.index_list[rev]
+            ends.append(flux.sample_at(to_index))
+        flux_list = flux_list[:ends[-1]]
+
+        # A cell value of zero is reserved: we lengthen such a sample by one
+        # tick and shorten the next sample to compensate. That may cascade,
+        # so candidate samples are resolved in order (they are rare).
+        adj = np.zeros(len(flux_list)+1, dtype=np.int64)
+        for i in np.flatnonzero((flux_list & 65535) <= 1).tolist():
+            if ((flux_list[i] - adj[i]) & 65535) == 0:
+                adj[i+1] = 1
+        flux_list += adj[1:] - adj[:-1]
+
+        # Each sample is encoded as zero or more 0x0000 overflow cells, each
+        # worth 65536 ticks, followed by a big-endian cell with the rest.
+        nr_cells = (flux_list >> 16) + 1
+        cell_ends = np.cumsum(nr_cells)
+        cells = np.zeros(int(cell_ends[-1]) if len(cell_ends) else 0,
+                         dtype='>u2')
+        cells[cell_ends - 1] = flux_list & 65535
+        dat = bytearray(cells.tobytes())
+
+        # Build the TDH entry for each full revolution.
+        s = 0
+        for rev in range(nr_revs):
+            e = ends[rev]
+            len_at_index = 2 * (int(cell_ends[s-1]) if s else 0)
+            nr = int(cell_ends[e-1]) if e else 0
             tdh += struct.pack("<III",
                                int(round(flux.index_list[rev]*factor)),
-                               (len(dat) - len_at_index) // 2,
+                               nr - len_at_index // 2,
                                4 + nr_revs*12 + len_at_index)
-            len_at_index = len(dat)
-            rev += 1
+            s = e
+
+        if self._csum is not None:
+            self._csum += checksum(tdh) + checksum(dat)
+        if self._f is None:
+            self.track_list.append((tdh, dat))
+            return
 
-        self.track_list.append((tdh, dat))
+        # Streaming to file: write the track out at the end of the file.
+        self._trk_offs.append(self._trk_end)
+        self._f.write(tdh)
+        self._f.write(dat)
+        self._trk_end += len(tdh) + len(dat)
 
 
     def get_image(self):
@@ -162,29 +213,51 @@ class SCP:
         # Generate the TLUT and concatenate all the tracks together.
         trk_offs = bytearray(s_trk * 4)
         trk_dat = bytearray()
-        for tdh, dat in self.track_list:
+        for off in range(len(self.track_list)):
+            if self.track_list[off] is None:
+                self._parse_track(off)
+            tdh, dat = self.track_list[off]
             trk_offs += struct.pack("<I", 0x2b0 + len(trk_dat))
-            trk_dat += tdh + dat
+            trk_dat += tdh
+            trk_dat += dat
         trk_offs += bytes(0x2a0 - len(trk_offs))
         # Calculate checksum over all data (except 16-byte image header).
-        csum = 0
-        for x in trk_offs:
-            csum += x
-        for x in trk_dat:
-            csum += x
-        # Generate the image header.
-        header = struct.pack("<3s9BI",
-                             b"SCP",    # Signature
-                             0,         # Version
-                             0x80,      # DiskType = Other
-                             self.nr_revs, s_trk, e_trk,
-                             0x01,      # Flags = Index
-                             0,         # 16-bit cell width
-                             1 if self.nr_sides == 1 else 0,
-                             0,         # 25ns capture
-                             csum & 0xffffffff)
+        # The track data is summed as tracks are appended, unless the image
+        # was parsed from a file.
+        csum = checksum(trk_offs)
+        csum += checksum(trk_dat) if self._csum is None else self._csum
         # Concatenate it all together and send it back.
-        return header + trk_offs + trk_dat
+        return self._header(s_trk, e_trk, csum) + trk_offs + trk_dat
+
+
+    # close:
+    # Completes an image being written by to_file(), by going back to fill
+    # in the image header and track offset table. The file is left open.
+    def close(self):
+        s_trk = self.start_cyl * self.nr_sides
+        e_trk = s_trk + len(self._trk_offs) - 1
+        trk_offs = bytes(s_trk * 4)
+        trk_offs += struct.pack("<%dI" % len(self._trk_offs), *self._trk_offs)
+        trk_offs += bytes(0x2a0 - len(trk_offs))
+        csum = self._csum + checksum(trk_offs)
+        self._f.seek(0)
+        self._f.write(self._header(s_trk, e_trk, csum) + trk_offs)
+        self._f.seek(self._trk_end)
+
+
+    # _header:
+    # Generates the 16-byte image header.
+    def _header(self, s_trk, e_trk, csum):
+        return struct.pack("<3s9BI",
+                           b"SCP",    # Signature
+                           0,         # Version
+                           0x80,      # DiskType = Other
+                           self.nr_revs, s_trk, e_trk,
+                           0x01,      # Flags = Index
+                           0,         # 16-bit cell width
+                           1 if self.nr_sides == 1 else 0,
+                           0,         # 25ns capture
+                           csum & 0xffffffff)
 
 
 # Local variables:
@@ -0,0 +1,322 @@
+# greaseweazle/sim.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import struct, time, random, collections
+import numpy as np
+
+from greaseweazle import version
+from greaseweazle.usb import ControlCmd, Cmd, Ack, Params
+from greaseweazle.usb import FluxEncoder, FluxDecoder
+from greaseweazle.image.scp import SCP
+
+## SimPort:
+## An in-process Greaseweazle emulator, presented as a Pyserial-compatible
+## port object so that it can be passed straight to usb.Unit. Flux is
+## served from an SCP image or from synthetic MFM tracks, and tracks written
+## to the emulated disk are read back on subsequent reads.
+##
+##  image:     SCP image filename, or None for synthetic tracks
+##  realtime:  model drive mechanics (rotation, head steps, motor spin-up)
+##  latency:   seconds from a command reaching the unit to its response
+##  bandwidth: maximum bytes/sec of a flux stream (None: unlimited)
+##  wrprot:    emulated disk is write protected
+class SimPort:
+
+    sample_freq = 72000000
+    max_index = 15
+    usb_frame = 0.001
+
+    def __init__(self, image=None, realtime=False, latency=0.0,
+                 bandwidth=None, rpm=300, wrprot=False, seed=0):
+        self.realtime = realtime
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.wrprot = wrprot
+        self.timeout = None
+        self.is_open = True
+        self.rev_ticks = self.sample_freq * 60 // rpm
+        self.image = None
+        if image is not None:
+            with open(image, "rb") as f:
+                self.image = SCP.from_file(f.read())
+        self.tracks = dict()
+        self.random = random.Random(seed)
+        self.encoder = FluxEncoder()
+        self.delays = [10, 3000, 15, 750, 10000] # Firmware defaults
+        self.cyl = self.side = 0
+        self.selected = self.motor = False
+        self.index_times = [0] * self.max_index
+        self.flux_status = Ack.Okay
+        self._baudrate = ControlCmd.Normal
+        self._reset()
+
+    def _reset(self):
+        self.inbuf = bytearray()
+        self.outq = collections.deque()
+        self.writer, self.write_len = None, 0
+        self.busy_until = time.monotonic()
+
+    ## Pyserial port interface.
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    @property
+    def baudrate(self):
+        return self._baudrate
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self._baudrate = baudrate
+        if baudrate == ControlCmd.ClearComms:
+            self._reset()
+
+    def reset_input_buffer(self):
+        self.outq.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    @property
+    def in_waiting(self):
+        now, n = time.monotonic(), 0
+        for seg in self.outq:
+            avail = self._seg_avail(seg, now)
+            n += avail - seg[1]
+            if avail < len(seg[0]):
+                break
+        return n
+
+    def read(self, size=1):
+        b = bytearray(size)
+        return bytes(b[:self.readinto(b)])
+
+    def readinto(self, b):
+        b = memoryview(b).cast('B')
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        pos = 0
+        while pos < len(b) and self.outq:
+            now = time.monotonic()
+            seg = self.outq[0]
+            avail = self._seg_avail(seg, now)
+            if avail > seg[1]:
+                n = min(avail - seg[1], len(b) - pos)
+                b[pos:pos+n] = seg[0][seg[1]:seg[1]+n]
+                pos += n
+                seg[1] += n
+                if seg[1] == len(seg[0]):
+                    self.outq.popleft()
+                    if not self.outq:
+                        self._receive()
+                continue
+            # Sleep until more data is due, or the read times out.
+            due = self._seg_due(seg, seg[1] + 1)
+            if deadline is not None and due > deadline:
+                time.sleep(max(deadline - now, 0))
+                break
+            time.sleep(max(due - now, 0))
+        return pos
+
+    def write(self, dat):
+        self.inbuf += dat
+        self._receive()
+        return len(dat)
+
+    ## _receive:
+    ## Process received data as the firmware does. The firmware gathers
+    ## received packets into one buffer until it can send its response to
+    ## a command (and does not receive at all while sending a flux stream).
+    ## So a command is processed only when the host has read all earlier
+    ## responses, and then everything received after the command is
+    ## discarded, including any further commands.
+    def _receive(self):
+        if self.writer is not None:
+            self._write_flux_data()
+        elif (not self.outq and len(self.inbuf) >= 2
+              and len(self.inbuf) >= self.inbuf[1]):
+            cmd = bytes(self.inbuf[:max(self.inbuf[1], 2)])
+            self.inbuf = bytearray()
+            self._command(cmd)
+
+    ## Output queue: Each segment is [data, consumed, start, rate]. Data
+    ## becomes available at @start, and thereafter at @rate bytes/sec,
+    ## delivered once per USB frame.
+
+    def _queue(self, dat, start=None, rate=None):
+        if start is None:
+            start = self._complete(0)
+        self.outq.append([memoryview(bytes(dat)), 0, start, rate])
+
+    def _seg_avail(self, seg, now):
+        dat, _, start, rate = seg
+        if now < start:
+            return 0
+        if rate is None:
+            return len(dat)
+        frames = (now - start) // self.usb_frame
+        return min(len(dat), int(frames * self.usb_frame * rate))
+
+    def _seg_due(self, seg, nr):
+        _, _, start, rate = seg
+        if rate is None:
+            return start
+        frames = -(-nr // (self.usb_frame * rate))
+        return start + frames * self.usb_frame
+
+    ## _complete:
+    ## Occupy the unit for @secs (if modelling real time), and return the
+    ## time at which the unit's response becomes available to the host.
+    def _complete(self, secs):
+        now = time.monotonic()
+        self.busy_until = max(now, self.busy_until)
+        if self.realtime:
+            self.busy_until += secs
+        return self.busy_until + self.latency
+
+    def _ack(self, cmd, ack=Ack.Okay, dat=bytes(), secs=0):
+        self._queue(bytes([cmd, ack]) + dat, self._complete(secs))
+
+    ## Command processing.
+
+    def _command(self, cmd):
+        c, n = cmd[0], cmd[1]
+        if c == Cmd.GetInfo and n == 3 and cmd[2] == 0:
+            info = struct.pack("<4BI24x", version.major, version.minor,
+                               self.max_index, Cmd.Select, self.sample_freq)
+            self._ack(c, dat=info)
+        elif c == Cmd.Seek and n == 3 and cmd[2] <= 85:
+            # The firmware always waits for the heads to settle.
+            steps = abs(cmd[2] - self.cyl)
+            self.cyl = cmd[2]
+            secs = steps * self.delays[1] / 1e6 + self.delays[2] / 1e3
+            self._ack(c, secs=secs)
+        elif c == Cmd.Side and n == 3 and cmd[2] <= 1:
+            self.side = cmd[2]
+            self._ack(c)
+        elif (c == Cmd.SetParams and 3 <= n <= 3+2*5
+              and cmd[2] == Params.Delays):
+            x = struct.unpack("<%dH" % ((n-3)//2), cmd[3:n-(n-3)%2])
+            self.delays[:len(x)] = x
+            self._ack(c)
+        elif (c == Cmd.GetParams and n == 4 and cmd[2] == Params.Delays
+              and cmd[3] <= 2*5):
+            self._ack(c, dat=struct.pack("<5H", *self.delays)[:cmd[3]])
+        elif c == Cmd.Motor and n == 3 and cmd[2] <= 1:
+            on = bool(cmd[2]) and not self.motor
+            self.motor = bool(cmd[2])
+            self._ack(c, secs=self.delays[3] / 1e3 if on else 0)
+        elif c == Cmd.Select and n == 3 and cmd[2] <= 1:
+            self.selected = bool(cmd[2])
+            self._ack(c, secs=self.delays[0] / 1e6)
+        elif c == Cmd.ReadFlux and n == 3 and 1 <= cmd[2] <= self.max_index:
+            self._ack(c)
+            self._read_flux(cmd[2])
+        elif c == Cmd.WriteFlux and n == 7:
+            if self.wrprot:
+                self._ack(c, Ack.Wrprot)
+            else:
+                self._ack(c)
+                self.writer, self.write_len = FluxDecoder(), 0
+        elif c == Cmd.GetFluxStatus and n == 2:
+            self._ack(c, self.flux_status)
+        elif (c == Cmd.GetIndexTimes and n == 4
+              and cmd[2] + cmd[3] <= self.max_index):
+            x = self.index_times[cmd[2]:cmd[2]+cmd[3]]
+            self._ack(c, dat=struct.pack("<%dI" % cmd[3], *x))
+        else:
+            self._ack(c, Ack.BadCommand)
+
+    ## _track:
+    ## Returns one revolution of flux for the current track, and the
+    ## revolution period, in emulated sample ticks.
+    def _track(self):
+        key = (self.cyl, self.side)
+        if key in self.tracks:
+            return self.tracks[key]
+        flux = None
+        if self.image is not None:
+            flux = self.image.get_track(self.cyl, self.side, writeout=True)
+        if flux is not None:
+            flux = flux.resample(self.sample_freq / flux.sample_freq)
+            track = (flux, int(flux.sum(dtype=np.int64)))
+        else:
+            track = self._synthetic_track()
+        self.tracks[key] = track
+        return track
+
+    ## _synthetic_track:
+    ## Generates a revolution of random HD MFM flux (2, 3 or 4 microsecond
+    ## intervals, with jitter). The content depends only on the track.
+    def _synthetic_track(self):
+        rng = np.random.default_rng((self.cyl, self.side))
+        cell = self.sample_freq // 1000000
+        n = self.rev_ticks // cell
+        flux = rng.integers(2, 5, n) * cell
+        flux += rng.integers(-cell//20, cell//20 + 1, n)
+        ticks = np.cumsum(flux)
+        flux = flux[:np.searchsorted(ticks, self.rev_ticks)+1]
+        flux[-1] -= ticks[len(flux)-1] - self.rev_ticks
+        return flux.astype(np.uint32), self.rev_ticks
+
+    ## _read_flux:
+    ## Stream flux from a random rotational position until @nr_idx index
+    ## pulses have passed.
+    def _read_flux(self, nr_idx):
+        self.index_times = [0] * self.max_index
+        if not (self.selected and self.motor):
+            self.flux_status = Ack.NoIndex
+            self._queue(bytes(1))
+            return
+        flux, ticks = self._track()
+        start = self.random.randrange(len(flux))
+        stream = np.concatenate([flux[start:]] + [flux] * (nr_idx-1))
+        self.index_times[0] = int(flux[start:].sum())
+        self.index_times[1:nr_idx] = [ticks] * (nr_idx-1)
+        self.flux_status = Ack.Okay
+        dat = self.encoder.encode(stream)
+        # Flux is produced as the disk rotates, and limited by bandwidth.
+        secs = sum(self.index_times) / self.sample_freq
+        rate = len(dat) / secs if self.realtime else None
+        if self.bandwidth is not None:
+            rate = min(rate or self.bandwidth, self.bandwidth)
+        self._queue(dat, self._complete(0), rate)
+        self._complete(secs)
+
+    ## _write_flux_data:
+    ## Consume flux-stream bytes following a WriteFlux command. The stream
+    ## is written from the index mark for at most one revolution.
+    def _write_flux_data(self):
+        # Anything received after the end of the stream is discarded.
+        end = self.inbuf.find(0)
+        dat = bytes(self.inbuf[:end+1] if end >= 0 else self.inbuf)
+        self.inbuf = bytearray()
+        self.writer.feed(dat)
+        self.write_len += len(dat)
+        if end < 0:
+            return
+        flux = self.writer.finish()
+        self.writer = None
+        _, ticks = self._track()
+        flux_ticks = np.cumsum(flux, dtype=np.int64)
+        n = np.searchsorted(flux_ticks, ticks)
+        rest = ticks - (flux_ticks[n-1] if n else 0)
+        flux = np.append(flux[:n], [rest] if rest else [])
+        self.tracks[(self.cyl, self.side)] = (flux.astype(np.uint32), ticks)
+        self.flux_status = Ack.Okay
+        # Wait for the index mark, then write one revolution.
+        secs = 1.5 * ticks / self.sample_freq
+        if self.bandwidth is not None:
+            secs = max(secs, self.write_len / self.bandwidth)
+        self._queue(bytes([Ack.Okay]), self._complete(secs))
+
+# Local variables:
+# python-indent: 4
+# End:
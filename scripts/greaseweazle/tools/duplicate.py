@@ -0,0 +1,143 @@
+# greaseweazle/tools/duplicate.py
+#
+# Greaseweazle control script: Duplicate Image to Multiple Disks.
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import sys, argparse, time
+from concurrent.futures import ThreadPoolExecutor
+
+from greaseweazle.tools import util, read, write
+from greaseweazle import usb as USB
+
+# convert_track:
+# Converts a track of the image for units with the given sample frequency.
+# Returns the flux list and its encoded stream, or None if the track is not
+# in the image.
+def convert_track(image, cyl, side, sample_freq):
+    flux = image.get_track(cyl, side, writeout=True)
+    if not flux:
+        return None
+    flux_list = flux.resample(sample_freq / flux.sample_freq)
+    return flux_list, bytes(USB.FluxEncoder().encode(flux_list))
+
+
+# duplicate_to_drive:
+# Writes the converted tracks to the disk in the unit's drive. Returns the
+# list of tracks which failed to verify.
+def duplicate_to_drive(usb, tracks, args):
+    failures = []
+    try:
+        usb.drive_select(True)
+        usb.drive_motor(True)
+        for cyl, side, conversion in tracks:
+            track = conversion.result()
+            if track is None:
+                continue
+            flux_list, stream = track
+            usb.seek(cyl, side)
+            for retry in range(args.verify_retries + 1):
+                usb.write_stream(stream)
+                if not args.verify or write.verify_track(usb, flux_list):
+                    break
+            else:
+                failures.append("%u.%u" % (cyl, side))
+    finally:
+        usb.drive_motor(False)
+        usb.drive_select(False)
+    return failures
+
+
+# duplicate:
+# Writes the image file to the disks in all of the given units at once.
+# Each track is converted once for all units, by a shared worker thread,
+# and each unit is driven by its own I/O thread.
+def duplicate(units, args):
+
+    image_class = util.get_image_class(args.file)
+    if not image_class:
+        return
+    image = image_class.from_file(util.map_file(args.file))
+
+    print("Duplicating %s to %u drives..." % (args.file, len(units)))
+    start = time.monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as converter, \
+         ThreadPoolExecutor(max_workers=len(units)) as workers:
+        # Tracks are converted in order, while the first are being written.
+        conversions = dict()
+        for sample_freq in sorted(set(usb.sample_freq for _, usb in units)):
+            conversions[sample_freq] = [
+                (cyl, side, converter.submit(convert_track, image,
+                                             cyl, side, sample_freq))
+                for cyl in range(args.scyl, args.ecyl+1)
+                for side in range(0, args.nr_sides)]
+        for devicename, usb in units:
+            job = workers.submit(duplicate_to_drive, usb,
+                                 conversions[usb.sample_freq], args)
+            results.append((devicename, usb, job))
+
+        # Report each drive's result.
+        nr_ok = 0
+        for i, (devicename, usb, job) in enumerate(results):
+            try:
+                failures = job.result()
+            except Exception as error:
+                result = "Failed: %s" % error
+            else:
+                if failures:
+                    result = "Verify Failed on Tracks: %s" % " ".join(failures)
+                else:
+                    result = "OK"
+                    nr_ok += 1
+            print("Drive %u (%s): %s (%u commands saved)"
+                  % (i, devicename, result, sum(usb.saved_cmds.values())))
+
+    secs = time.monotonic() - start
+    print("%u/%u disks duplicated in %.1fs: %.1f disks/hour"
+          % (nr_ok, len(units), secs, nr_ok * 3600 / secs))
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--scyl", type=int, default=0,
+                        help="first cylinder to write")
+    parser.add_argument("--ecyl", type=int, default=81,
+                        help="last cylinder to write")
+    parser.add_argument("--single-sided", action="store_true",
+                        help="single-sided write")
+    parser.add_argument("--verify", action="store_true",
+                        help="read back and verify each track after writing")
+    parser.add_argument("--verify-retries", type=int, default=3,
+                        help="rewrites of a track which fails to verify")
+    parser.add_argument("--master", metavar="DEVICE",
+                        help="first read the master disk in DEVICE to file")
+    parser.add_argument("--revs", type=int, default=3,
+                        help="number of revolutions to read from master disk")
+    parser.add_argument("file", help="image filename")
+    parser.add_argument("device", nargs="+", help="serial devices")
+    parser.prog += ' ' + argv[1]
+    args = parser.parse_args(argv[2:])
+    args.nr_sides = 1 if args.single_sided else 2
+
+    try:
+        if args.master:
+            usb = util.usb_open(args.master)
+            util.with_drive_selected(read.read_to_image, usb, args)
+        units = [(d, util.usb_open(d)) for d in args.device]
+        duplicate(units, args)
+    except USB.CmdError as error:
+        print("Command Failed: %s" % error)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -0,0 +1,164 @@
+# greaseweazle/tools/pllbench.py
+#
+# Greaseweazle control script: Benchmark Clock-Recovery Engines.
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import sys, argparse, time
+import numpy as np
+from bitarray import bitarray
+
+from greaseweazle.tools import util
+from greaseweazle.flux import Flux
+from greaseweazle import bitcell
+
+engines = { 'pll': bitcell.PLL,
+            'fixed': bitcell.FixedClock,
+            'adaptive': bitcell.AdaptivePLL }
+
+# Synthetic disk formats: (name, bitcell time, sectors per track).
+formats = [ ('mfm-dd', 2e-6, 9),
+            ('mfm-hd', 1e-6, 18) ]
+
+# Synthetic drive conditions: (name, speed, jitter, wobble). Speed is
+# relative to nominal, jitter is the standard deviation of each flux
+# transition's time (relative to a bitcell), and wobble is the amplitude of
+# a once-per-revolution speed variation.
+conditions = [ ('nominal', 1.00, 0.03, 0.000),
+               ('jitter',  1.00, 0.10, 0.000),
+               ('fast',    1.02, 0.03, 0.000),
+               ('wobble',  1.00, 0.03, 0.010) ]
+
+# MFM sync word 0x4489, three times.
+mfm_sync = bitarray('0100010010001001') * 3
+
+# mfm_encode:
+# Returns the MFM bitcells for the given bytes, given the preceding data bit.
+def mfm_encode(dat, prev=0):
+    d = np.unpackbits(np.frombuffer(dat, dtype=np.uint8))
+    p = np.concatenate(([prev], d[:-1]))
+    cells = np.empty(2*len(d), dtype=np.uint8)
+    cells[0::2] = 1 - (d | p)
+    cells[1::2] = d
+    bits = bitarray()
+    bits.pack(cells.tobytes())
+    return bits
+
+
+# mfm_track:
+# Returns a synthetic flux track of @nr_revs revolutions at 300rpm, and the
+# bitcells of each of its sectors, which should be found in every decoded
+# revolution. Each sector is a sync mark and 513 bytes of random data.
+def mfm_track(rng, clock, nr_secs, speed, jitter, wobble,
+              nr_revs=2, sample_freq=72000000):
+    track, sectors = bitarray(), []
+    for i in range(nr_secs):
+        track += mfm_encode(b'\x4e' * 40) + mfm_encode(bytes(12))
+        sector = mfm_sync + mfm_encode(rng.bytes(513), prev=1)
+        track += sector
+        sectors.append(sector)
+    rev_cells = int(0.2 / clock)
+    track += mfm_encode(b'\x4e' * ((rev_cells - len(track)) // 16))
+    track += bitarray(rev_cells - len(track))
+    # Time of every flux transition, with speed variations and jitter.
+    cells = np.frombuffer(track.unpack(), dtype=np.uint8)
+    pos = np.flatnonzero(np.tile(cells, nr_revs)) + 1
+    t = pos * clock / speed
+    period = rev_cells * clock / speed
+    t += wobble * period / (2*np.pi) * np.sin(2*np.pi * t / period)
+    t += rng.normal(0, jitter * clock, len(t))
+    ticks = np.rint(np.sort(t) * sample_freq).astype(np.int64)
+    index_list = [int(round(period * sample_freq))] * nr_revs
+    flux = Flux(index_list, np.diff(ticks, prepend=0), sample_freq)
+    return flux, sectors
+
+
+# run_engine:
+# Decodes the given flux tracks with the named engine, and returns the
+# number of bitcells decoded, the time taken, and the number of sectors
+# found out of those expected.
+def run_engine(name, clock, tracks):
+    nr_cells = found = expected = 0
+    secs = 0.0
+    for flux, sectors in tracks:
+        b = bitcell.Bitcell()
+        b.clock, b.engine, b.collect_times = clock, engines[name](), False
+        t = time.perf_counter()
+        b.read_flux(flux)
+        secs += time.perf_counter() - t
+        for bits, _ in b.revolution_list:
+            nr_cells += len(bits)
+        if sectors is None:
+            continue
+        for bits, _ in b.revolution_list[:len(flux.index_list)]:
+            found += sum(bits.find(s) >= 0 for s in sectors)
+        expected += len(sectors) * len(flux.index_list)
+    return nr_cells, secs, found, expected
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--engines", default=",".join(engines),
+                        help="comma-separated clock-recovery engines")
+    parser.add_argument("--tracks", type=int, default=4,
+                        help="synthetic tracks per format and condition")
+    parser.add_argument("--clock", type=float, default=2.0,
+                        help="bitcell time (us) for image files")
+    parser.add_argument("file", nargs="*",
+                        help="image files (throughput only)")
+    parser.prog += ' ' + argv[1]
+    args = parser.parse_args(argv[2:])
+    names = args.engines.split(",")
+    for name in names:
+        if name not in engines:
+            print("**Error: Unknown engine '%s'" % name)
+            return 1
+
+    # Build the corpus: synthetic tracks with known sector data, and the
+    # tracks of any given image files.
+    rng = np.random.default_rng(0)
+    corpus = []
+    for fmt, clock, nr_secs in formats:
+        for cond, speed, jitter, wobble in conditions:
+            tracks = [mfm_track(rng, clock, nr_secs, speed, jitter, wobble)
+                      for i in range(args.tracks)]
+            corpus.append((fmt, cond, clock, tracks))
+    for name in args.file:
+        image_class = util.get_image_class(name)
+        if not image_class:
+            return 1
+        image = image_class.from_file(util.map_file(name))
+        tracks = []
+        for cyl in range(0, 100):
+            for side in range(0, 2):
+                flux = image.get_track(cyl, side)
+                if flux is not None:
+                    tracks.append((flux, None))
+        corpus.append((name, '-', args.clock / 1000000, tracks))
+
+    print("%-10s %-16s %-8s %10s %9s" % ("Engine", "Format", "Condition",
+                                         "Sectors", "Mcells/s"))
+    for name in names:
+        total_cells = total_secs = 0
+        for fmt, cond, clock, tracks in corpus:
+            nr_cells, secs, found, expected = run_engine(name, clock, tracks)
+            total_cells += nr_cells
+            total_secs += secs
+            sectors = "%u/%u" % (found, expected) if expected else "-"
+            print("%-10s %-16s %-8s %10s %9.2f"
+                  % (name, fmt, cond, sectors, nr_cells / secs / 1e6))
+        print("%-10s %-16s %-8s %10s %9.2f"
+              % (name, "all", "", "", total_cells / total_secs / 1e6))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -7,7 +7,8 @@
 # This is free and unencumbered software released into the public domain.
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
-import sys, argparse
+import os, sys, argparse, collections
+from concurrent.futures import ThreadPoolExecutor
 
 from greaseweazle.tools import util
 from greaseweazle import usb as USB
@@ -19,19 +20,43 @@ def read_to_image(usb, args):
     image_class = util.get_image_class(args.file)
     if not image_class:
         return
-    image = image_class(args.scyl, args.nr_sides)
 
-    for cyl in range(args.scyl, args.ecyl+1):
-        for side in range(0, args.nr_sides):
-            print("\rReading Track %u.%u..." % (cyl, side), end="")
-            usb.seek(cyl, side)
-            image.append_track(usb.read_track(args.revs))
+    # The image is written to a temporary file as it is built, which
+    # replaces any existing image file only once it is complete.
+    tmp = "%s.%u.tmp" % (args.file, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            image = image_class.to_file(f, args.scyl, args.nr_sides)
+            read_tracks(usb, args, image)
+            image.close()
+        os.replace(tmp, args.file)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    print("%u drive commands saved" % sum(usb.saved_cmds.values()))
 
-    print()
 
-    # Write the image file.
-    with open(args.file, "wb") as f:
-        f.write(image.get_image())
+# read_tracks:
+# Reads the disk's tracks and appends them to the given image.
+def read_tracks(usb, args, image):
+
+    # Tracks are appended to the image by a worker thread, in order, while
+    # we seek to and read the next track. A small backlog is allowed.
+    with ThreadPoolExecutor(max_workers=1) as worker:
+        pending = collections.deque()
+        for cyl in range(args.scyl, args.ecyl+1):
+            for side in range(0, args.nr_sides):
+                print("\rReading Track %u.%u..." % (cyl, side), end="")
+                usb.seek(cyl, side)
+                flux = usb.read_track(args.revs)
+                pending.append(worker.submit(image.append_track, flux))
+                if len(pending) > 2:
+                    pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+
+    print()
 
 
 def main(argv):
@@ -0,0 +1,74 @@
+# greaseweazle/tools/stress.py
+#
+# Greaseweazle control script: Stress Test Many Units Concurrently.
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import sys, argparse, asyncio, time
+
+from greaseweazle.tools import util
+from greaseweazle.aio import AsyncUnit
+
+# read_disk:
+# Reads the given tracks from the unit. Returns the number of tracks read.
+async def read_disk(unit, args):
+    await unit.drive_select(True)
+    await unit.drive_motor(True)
+    try:
+        for cyl in range(args.tracks):
+            await unit.seek(cyl, 0)
+            await unit.read_track(args.revs)
+    finally:
+        await unit.drive_motor(False)
+        await unit.drive_select(False)
+    return args.tracks
+
+
+# stress:
+# Opens @nr units on emulated ports and reads from all of them at once.
+# Returns the number of tracks read and the time taken.
+async def stress(nr, args):
+    units = await asyncio.gather(
+        *[AsyncUnit.open(util.open_port(args.device)) for i in range(nr)])
+    try:
+        start = time.monotonic()
+        tracks = await asyncio.gather(*[read_disk(u, args) for u in units])
+        return sum(tracks), time.monotonic() - start
+    finally:
+        for unit in units:
+            unit.close()
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--units", default="1,4,8,16",
+                        help="comma-separated numbers of units to run")
+    parser.add_argument("--tracks", type=int, default=8,
+                        help="tracks to read per unit")
+    parser.add_argument("--revs", type=int, default=2,
+                        help="revolutions to read per track")
+    parser.add_argument("device", nargs="?", default="sim:",
+                        help="emulated device (sim: or sim:<file.scp>)")
+    parser.prog += ' ' + argv[1]
+    args = parser.parse_args(argv[2:])
+    if not args.device.startswith("sim:"):
+        print("**Error: Only emulated devices (sim:) may be stress tested")
+        return 1
+
+    print("%5s %8s %8s %10s" % ("Units", "Tracks", "Secs", "Tracks/s"))
+    for nr in [int(x) for x in args.units.split(",")]:
+        tracks, secs = asyncio.run(stress(nr, args))
+        print("%5u %8u %8.2f %10.1f" % (nr, tracks, secs, tracks / secs))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -7,10 +7,11 @@
 # This is free and unencumbered software released into the public domain.
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
-import os, sys, serial
+import os, sys, mmap, serial
 
 from greaseweazle import version
 from greaseweazle import usb as USB
+from greaseweazle.sim import SimPort
 from greaseweazle.image.scp import SCP
 from greaseweazle.image.hfe import HFE
 
@@ -24,7 +25,16 @@ def get_image_class(name):
     return image_types[ext.lower()]
 
 
+# map_file:
+# Returns the contents of the named file as a read-only memory map, so that
+# image parsers read only the parts of the file that they use.
+def map_file(name):
+    with open(name, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 def with_drive_selected(fn, usb, args):
+    usb.saved_cmds.clear()
     try:
         usb.drive_select(True)
         usb.drive_motor(True)
@@ -39,9 +49,20 @@ def with_drive_selected(fn, usb, args):
         usb.drive_select(False)
 
 
+# open_port:
+# Opens the named device. The name "sim:" selects the built-in Greaseweazle
+# emulator, serving synthetic tracks, and "sim:<file.scp>" serves the
+# tracks of the given image.
+def open_port(devicename):
+    if devicename.startswith("sim:"):
+        return SimPort(devicename[4:] or None, realtime=True,
+                       latency=0.0005, bandwidth=1000000)
+    return serial.Serial(devicename)
+
+
 def usb_open(devicename, is_update=False):
 
-    usb = USB.Unit(serial.Serial(devicename))
+    usb = USB.Unit(open_port(devicename))
 
     print("** %s v%u.%u, Host Tools v%u.%u"
           % (("Greaseweazle", "Bootloader")[usb.update_mode],
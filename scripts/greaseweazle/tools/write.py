@@ -7,10 +7,58 @@
 # This is free and unencumbered software released into the public domain.
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
-import sys, argparse
+import sys, argparse, hashlib
+import numpy as np
 
 from greaseweazle.tools import util
 from greaseweazle import usb as USB
+from greaseweazle.cache import StreamCache
+
+# flux_mismatch:
+# Aligns the flux intervals read back from a track with the intervals that
+# were written, and returns the fraction of intervals which do not match.
+# Intervals are compared in sequence, which is unaffected by drive speed
+# drift. The offset (in intervals) between the two is searched for over
+# the first window of the track, and is then realigned in each following
+# window, so that a missing or extra flux transition costs only the
+# intervals around it. The ends of the track, around the index and write
+# splice, are ignored.
+def flux_mismatch(written, read, max_lag=16, tolerance=0.15, window=256,
+                  max_step=4):
+    a = np.asarray(written, dtype=np.float64)
+    b = np.asarray(read, dtype=np.float64)
+    m = min(len(a) * 99 // 100, len(b) - max_lag)
+    if m <= 4*max_lag:
+        return 0.0 if abs(len(a) - len(b)) <= max_lag else 1.0
+    a = a[max_lag:m]
+    # Pad the read intervals so that any alignment can be compared (and
+    # never matches beyond the end of the track).
+    b = np.concatenate((b, np.full(len(a) + 2*max_lag, np.inf)))
+    lag, nr_bad = None, 0
+    for s in range(0, len(a), window):
+        x = a[s:s+window]
+        if lag is None:
+            lo, hi = 0, 2*max_lag
+        else:
+            lo, hi = max(lag - max_step, 0), lag + max_step
+        w = np.lib.stride_tricks.sliding_window_view(
+            b[s+lo:s+hi+len(x)], len(x))
+        bad = np.count_nonzero(np.abs(w - x) > tolerance * x, axis=1)
+        i = int(np.argmin(bad))
+        # Keep the current alignment unless another is strictly better.
+        if lag is not None and bad[lag-lo] == bad[i]:
+            i = lag - lo
+        lag = lo + i
+        nr_bad += int(bad[i])
+    return nr_bad / len(a)
+
+
+# verify_track:
+# Reads back the current track, and returns True if it matches the given
+# flux list which was written to it.
+def verify_track(usb, flux_list):
+    return flux_mismatch(flux_list, usb.read_track(1).list) <= 0.01
+
 
 # write_from_image:
 # Writes the specified image file to floppy disk.
@@ -23,44 +71,85 @@ def write_from_image(usb, args):
         drive_ticks = (flux.index_list[0] + flux.index_list[1]) / 2
         del flux
 
-    # Read and parse the image file.
+    # Read the image file. It is parsed only if there are tracks to convert.
     image_class = util.get_image_class(args.file)
     if not image_class:
         return
-    with open(args.file, "rb") as f:
-        image = image_class.from_file(f.read())
-
+    dat = util.map_file(args.file)
+    image = None
+
+    # Encoded tracks may be cached, keyed by image content. With speed
+    # adjustment, the key includes the drive's revolution time quantised to
+    # 0.5ms (0.25% at 300rpm), so that repeat runs, and drives of similar
+    # speed, share entries. A cached track is then written for a speed up
+    # to 0.25% different from the measured one, which is well within the
+    # tolerance of the write splice.
+    cache = None
+    if args.cache:
+        cache = StreamCache(args.cache, args.cache_size * 1024 * 1024)
+        image_id = hashlib.sha256(dat).hexdigest()
+        speed_key = None
+        if args.adjust_speed:
+            speed_key = round(drive_ticks / usb.sample_freq / 0.0005)
+
+    verify_failures = []
     for cyl in range(args.scyl, args.ecyl+1):
         for side in range(0, args.nr_sides):
 
-            flux = image.get_track(cyl, side, writeout=True)
-            if not flux:
-                continue
+            stream = flux_list = None
+            if cache:
+                key = (image_id, cyl, side, usb.sample_freq, speed_key)
+                stream = cache.get(key)
+                if stream == bytes():
+                    continue # Track is not in the image
+
+            if stream is None:
+                if image is None:
+                    image = image_class.from_file(dat)
+                flux = image.get_track(cyl, side, writeout=True)
+                if not flux:
+                    if cache:
+                        cache.put(key, bytes())
+                    continue
+                if args.adjust_speed:
+                    # @factor adjusts flux times for speed variations between
+                    # the read-in and write-out drives.
+                    factor = drive_ticks / flux.index_list[0]
+                else:
+                    # Simple ratio between the GW and image sample frequencies.
+                    factor = usb.sample_freq / flux.sample_freq
+                # Convert the flux samples to Greaseweazle sample frequency.
+                flux_list = flux.resample(factor)
 
             print("\rWriting Track %u.%u..." % (cyl, side), end="")
             usb.seek(cyl, side)
 
-            if args.adjust_speed:
-                # @factor adjusts flux times for speed variations between the
-                # read-in and write-out drives.
-                factor = drive_ticks / flux.index_list[0]
-            else:
-                # Simple ratio between the GW and image sample frequencies.
-                factor = usb.sample_freq / flux.sample_freq
-
-            # Convert the flux samples to Greaseweazle sample frequency.
-            rem = 0.0
-            flux_list = []
-            for x in flux.list:
-                y = x * factor + rem
-                val = int(round(y))
-                rem = y - val
-                flux_list.append(val)
-
             # Encode the flux times for Greaseweazle, and write them out.
-            usb.write_track(flux_list)
+            # The encoded stream is reused for rewrites, and cached.
+            # If verifying, read the track back and rewrite it on mismatch.
+            for retry in range(args.verify_retries + 1):
+                if stream is None:
+                    stream = usb.write_track(flux_list)
+                    if cache:
+                        cache.put(key, b"".join(stream))
+                else:
+                    usb.write_stream(stream)
+                if not args.verify:
+                    break
+                if flux_list is None:
+                    decoder = USB.FluxDecoder()
+                    decoder.feed(stream)
+                    flux_list = decoder.finish()
+                if verify_track(usb, flux_list):
+                    break
+                print("\rTrack %u.%u Verify Failure..." % (cyl, side), end="")
+            else:
+                verify_failures.append("%u.%u" % (cyl, side))
 
     print()
+    if verify_failures:
+        print("**Verify Failed on Tracks: %s" % " ".join(verify_failures))
+    print("%u drive commands saved" % sum(usb.saved_cmds.values()))
 
 
 def main(argv):
@@ -75,6 +164,14 @@ def main(argv):
                         help="single-sided write")
     parser.add_argument("--adjust-speed", action="store_true",
                         help="adjust write-flux times for drive speed")
+    parser.add_argument("--verify", action="store_true",
+                        help="read back and verify each track after writing")
+    parser.add_argument("--verify-retries", type=int, default=3,
+                        help="rewrites of a track which fails to verify")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="cache encoded tracks in given directory")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="maximum size of the track cache (MB)")
     parser.add_argument("file", help="input filename")
     parser.add_argument("device", help="serial device")
     parser.prog += ' ' + argv[1]
@@ -5,7 +5,8 @@
 # This is free and unencumbered software released into the public domain.
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
-import struct
+import sys, struct, collections, time
+import numpy as np
 from greaseweazle import version
 from greaseweazle.flux import Flux
 
@@ -65,22 +66,190 @@ class CmdError(Exception):
         return "Unknown Error (%u)" % self.code
 
 
+## FluxDecoder:
+## Incrementally decodes a Greaseweazle flux stream as it is received.
+## An opcode which is split across chunks is held over to the next chunk.
+class FluxDecoder:
+
+    def __init__(self):
+        self.carry = bytes()
+        self.flux = []
+
+    ## feed:
+    ## Decode the next chunk of the stream.
+    def feed(self, dat):
+        if self.carry:
+            dat = self.carry + dat
+        flux, consumed = self._decode(dat)
+        self.flux.append(flux)
+        self.carry = bytes(dat[consumed:])
+
+    ## finish:
+    ## Return all flux samples decoded from the completed stream.
+    def finish(self):
+        flux = np.concatenate(self.flux)
+        assert flux[-1] == 0
+        return flux[:-1]
+
+    ## _decode:
+    ## Decode a chunk which starts on an opcode boundary. Returns the flux
+    ## samples and the number of bytes consumed.
+    @staticmethod
+    def _decode(dat):
+        dat = np.frombuffer(dat, dtype=np.uint8)
+        n = len(dat)
+        # Bytes >= 250 are opcodes unless they are operands of an earlier
+        # opcode. Only candidates within reach of an earlier candidate's
+        # operands are ambiguous: these are resolved in bulk, a few rounds
+        # at a time, and any long dependency chain is finished in order.
+        cand = np.flatnonzero(dat >= 250)
+        is_5b = dat[cand] == 255
+        end = cand + 2
+        end[is_5b] += 3
+        ambiguous = np.zeros(len(cand), dtype=bool)
+        for k in range(1, 5):
+            ambiguous[k:] |= cand[k:] < end[:-k]
+        is_op = ~ambiguous
+        unknown = np.flatnonzero(ambiguous)
+        for _ in range(8):
+            if not len(unknown):
+                break
+            covered, pending = np.zeros((2, len(unknown)), dtype=bool)
+            for k in range(1, 5):
+                j = np.maximum(unknown - k, 0)
+                reach = (unknown >= k) & (end[j] > cand[unknown])
+                covered |= reach & is_op[j]
+                pending |= reach & ambiguous[j]
+            is_op[unknown[~covered & ~pending]] = True
+            ambiguous[unknown[covered | ~pending]] = False
+            unknown = unknown[pending & ~covered]
+        for i in unknown.tolist():
+            is_op[i] = not any(is_op[j] and end[j] > cand[i]
+                               for j in range(max(i-4, 0), i))
+        # Every byte which is not an operand starts a flux sample.
+        is_start = np.ones(n+4, dtype=bool)
+        is_start[cand[is_op]+1] = False
+        for k in range(2, 5):
+            is_start[cand[is_op & is_5b]+k] = False
+        starts = np.flatnonzero(is_start[:n])
+        # Hold back a truncated opcode at the end of the chunk.
+        consumed = n
+        if len(starts) and not is_start[n]:
+            consumed = int(starts[-1])
+            starts = starts[:-1]
+        # Decode each opcode class in bulk.
+        dat = np.concatenate((dat, np.zeros(4, dtype=np.uint8)))
+        flux = dat[starts].astype(np.uint32)
+        big = flux >= 250
+        s = starts[big]
+        flux[big] = (flux[big] - 249) * 250 + dat[s+1] - 1
+        s = s[dat[s] == 255]
+        if len(s):
+            flux[starts.searchsorted(s)] = (
+                ((dat[s+1] & 254) >> 1).astype(np.uint32)
+                + ((dat[s+2] & 254).astype(np.uint32) <<  6)
+                + ((dat[s+3] & 254).astype(np.uint32) << 13)
+                + ((dat[s+4] & 254).astype(np.uint32) << 20))
+        return flux, consumed
+
+
+## FluxEncoder:
+## Converts flux timings into a Greaseweazle flux stream. The stream is
+## built in a buffer which is reused by subsequent calls.
+class FluxEncoder:
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    ## encode:
+    ## Convert the given flux timings into an encoded data stream.
+    ## The stream is returned as a view of the encoder's buffer.
+    def encode(self, flux):
+        return self._encode(np.asarray(flux, dtype=np.uint32), True)
+
+    ## encode_chunks:
+    ## Generator which converts the given flux timings @nr samples at a time,
+    ## yielding each chunk of the encoded data stream (as bytes) as soon as
+    ## it is ready. The final chunk ends the stream.
+    def encode_chunks(self, flux, nr):
+        flux = np.asarray(flux, dtype=np.uint32)
+        for i in range(0, max(len(flux), 1), nr):
+            yield bytes(self._encode(flux[i:i+nr], i+nr >= len(flux)))
+
+    def _encode(self, flux, end):
+        flux = flux[flux != 0]
+        # Output offset of each encoded sample.
+        nbytes = 1 + (flux >= 250) + 3*(flux >= 1500)
+        offs = np.cumsum(nbytes) - nbytes
+        total = int(nbytes.sum()) + int(end)
+        if len(self.buf) < total:
+            self.buf = bytearray(max(total, 2*len(self.buf)))
+        dat = np.frombuffer(self.buf, dtype=np.uint8, count=total)
+        # First byte of every sample, then trailing bytes of the 2- and
+        # 5-byte forms.
+        dat[offs] = np.where(flux < 250, flux, 249 + np.minimum(flux//250, 6))
+        i = np.flatnonzero(flux >= 250)
+        val, o = flux[i], offs[i]
+        dat[o+1] = np.where(val < 1500, 1 + val%250, 1 | (val<<1) & 255)
+        i = i[val >= 1500]
+        val, o = flux[i], offs[i]
+        dat[o+2] = 1 | (val>>6) & 255
+        dat[o+3] = 1 | (val>>13) & 255
+        dat[o+4] = 1 | (val>>20) & 255
+        if end:
+            dat[-1] = 0 # End of Stream
+        return memoryview(self.buf)[:total]
+
+
 class Unit:
 
+    ## Seconds to wait for more flux data before a read is abandoned.
+    flux_timeout = 5
+
+    ## Bytes of flux data to buffer before decoding them during a read.
+    decode_chunk = 16384
+
+    ## Flux samples to encode at a time during a write.
+    encode_chunk = 8192
+
+    ## Pipeline commands (see _send_cmd). The firmware processes only one
+    ## command per USB packet, so this relies on each write to the port
+    ## being sent as separate USB packets. The Linux CDC ACM driver submits
+    ## each write as its own transfer; other hosts' drivers may merge small
+    ## writes, so there each command is sent only when all earlier commands
+    ## have been acknowledged.
+    ## Furthermore, the firmware gathers all packets which arrive before it
+    ## can respond to a command into one buffer, and discards everything
+    ## after the command. So at most one command may be queued behind the
+    ## one in progress.
+    pipeline = sys.platform.startswith("linux")
+
     ## Unit information, instance variables:
     ##  major, minor: Greaseweazle firmware version number
     ##  max_index:    Maximum index timings for Cmd.ReadFlux
     ##  max_cmd:      Maximum Cmd number accepted by this unit
     ##  sample_freq:  Resolution of all time values passed to/from this unit
 
+    ## Drive state, as last commanded, instance variables (None if unknown):
+    ##  cyl, side:    Current head position
+    ##  selected:     Drive is selected
+    ##  motor:        Drive spindle motor is on
+    ## Commands which would not change the drive state are not sent, and are
+    ## instead counted in saved_cmds (a Counter keyed by Cmd), which callers
+    ## may clear per disk.
+
     ## Unit(ser):
-    ## Accepts a Pyserial instance for Greaseweazle communications.
+    ## Accepts a Pyserial instance for Greaseweazle communications, or any
+    ## port object with the same interface (eg. greaseweazle.sim.SimPort).
     def __init__(self, ser):
         self.ser = ser
+        self._encoder = FluxEncoder()
+        self._read_buf = bytearray(2 * self.decode_chunk)
+        self.saved_cmds = collections.Counter()
         self.reset()
         # Copy firmware info to instance variables (see above for definitions).
-        self._send_cmd(struct.pack("3B", Cmd.GetInfo, 3, 0))
-        x = struct.unpack("<4BI24x", self.ser.read(32))
+        x = struct.unpack("<4BI24x", self._send_cmd(
+            struct.pack("3B", Cmd.GetInfo, 3, 0), 32))
         (self.major, self.minor, self.max_index,
          self.max_cmd, self.sample_freq) = x
         # Check whether firmware is in update mode: limited command set if so.
@@ -97,10 +266,10 @@ class Unit:
         if self.update_needed:
             return
         # Initialise the delay properties with current firmware values.
-        self._send_cmd(struct.pack("4B", Cmd.GetParams, 4, Params.Delays, 10))
         (self._select_delay, self._step_delay,
          self._seek_settle_delay, self._motor_delay,
-         self._auto_off_delay) = struct.unpack("<5H", self.ser.read(10))
+         self._auto_off_delay) = struct.unpack("<5H", self._send_cmd(
+             struct.pack("4B", Cmd.GetParams, 4, Params.Delays, 10), 10))
 
 
     ## reset:
@@ -110,44 +279,142 @@ class Unit:
         self.ser.baudrate = ControlCmd.ClearComms
         self.ser.baudrate = ControlCmd.Normal
         self.ser.reset_input_buffer()
+        self._pending = collections.deque()
+        self._nr_sent = 0
+        self._rx = bytearray()
+        self.invalidate_state()
+
+
+    ## invalidate_state:
+    ## Forget the drive state, so that the next seek, drive_select and
+    ## drive_motor commands are sent unconditionally.
+    def invalidate_state(self):
+        self.cyl = self.side = self.selected = self.motor = None
+        self._last_cmd = time.monotonic()
+
+
+    ## _check_state:
+    ## The firmware deselects the drive and turns off its motor when it has
+    ## received no command for auto_off_delay. Forget the select and motor
+    ## state well before that can happen.
+    def _check_state(self):
+        if time.monotonic() - self._last_cmd > self._auto_off_delay / 2000:
+            self.selected = self.motor = None
+
+
+    ## _read:
+    ## Read @n bytes from Greaseweazle, starting with any bytes which were
+    ## received ahead of time (see _read_track).
+    def _read(self, n):
+        if len(self._rx) < n:
+            self._rx += self.ser.read(n - len(self._rx))
+        dat = bytes(self._rx[:n])
+        del self._rx[:n]
+        return dat
 
 
     ## _send_cmd:
-    ## Send given command byte sequence to Greaseweazle.
+    ## Send given command byte sequence to Greaseweazle, expecting @resp_len
+    ## bytes of response data after the acknowledgement.
+    ## If @wait is False the command is pipelined: its acknowledgement is
+    ## collected later by _get_ack(), so that further commands may be sent
+    ## without a round trip. Otherwise, wait for all outstanding commands
+    ## and return this command's response data.
+    ## The firmware processes one command per USB packet, so each command
+    ## must be written separately, and at most one may wait behind the
+    ## command in progress (see pipeline). Any other command is held until
+    ## the acknowledgements of earlier commands are collected.
     ## Raise a CmdError if command fails.
-    def _send_cmd(self, cmd):
-        self.ser.write(cmd)
-        (c,r) = struct.unpack("2B", self.ser.read(2))
+    def _send_cmd(self, cmd, resp_len=0, wait=True):
+        self._last_cmd = time.monotonic()
+        self._pending.append((cmd, resp_len))
+        self._write_cmds()
+        if wait:
+            while len(self._pending) > 1:
+                self._get_ack()
+            return self._get_ack()
+
+
+    ## _write_cmds:
+    ## Write the outstanding commands which may now be sent.
+    def _write_cmds(self):
+        while (self._nr_sent < len(self._pending)
+               and self._nr_sent < (2 if self.pipeline else 1)):
+            cmd, _ = self._pending[self._nr_sent]
+            self.ser.write(cmd)
+            self._nr_sent += 1
+
+
+    ## _get_ack:
+    ## Collect the acknowledgement of the oldest outstanding command, and
+    ## return its response data.
+    ## Raise a CmdError if the command failed, after first collecting the
+    ## acknowledgements of all commands which followed it (any which are
+    ## not yet sent are dropped).
+    def _get_ack(self):
+        cmd, resp_len = self._pending.popleft()
+        self._nr_sent -= 1
+        (c,r) = struct.unpack("2B", self._read(2))
         assert c == cmd[0]
         if r != 0:
+            while len(self._pending) > self._nr_sent:
+                self._pending.pop()
+            while self._pending:
+                try:
+                    self._get_ack()
+                except CmdError:
+                    pass
             raise CmdError(c, r)
+        dat = self._read(resp_len)
+        self._write_cmds()
+        return dat
 
 
     ## seek:
     ## Seek the selected drive's heads to the specified track (cyl, side).
     def seek(self, cyl, side):
-        self._send_cmd(struct.pack("3B", Cmd.Seek, 3, cyl))
-        self._send_cmd(struct.pack("3B", Cmd.Side, 3, side))
+        if cyl == self.cyl and side == self.side:
+            self.saved_cmds.update((Cmd.Seek, Cmd.Side))
+            return
+        # Forget the head position until the commands have succeeded.
+        cmds = []
+        if cyl == self.cyl:
+            self.saved_cmds[Cmd.Seek] += 1
+        else:
+            cmds.append(struct.pack("3B", Cmd.Seek, 3, cyl))
+        if side == self.side:
+            self.saved_cmds[Cmd.Side] += 1
+        else:
+            cmds.append(struct.pack("3B", Cmd.Side, 3, side))
+        self.cyl = self.side = None
+        for cmd in cmds[:-1]:
+            self._send_cmd(cmd, wait=False)
+        self._send_cmd(cmds[-1])
+        self.cyl, self.side = cyl, side
 
 
     ## drive_select:
     ## Select/deselect the drive.
     def drive_select(self, state):
+        self._check_state()
+        if bool(state) == self.selected:
+            self.saved_cmds[Cmd.Select] += 1
+            return
+        self.selected = None
         self._send_cmd(struct.pack("3B", Cmd.Select, 3, int(state)))
+        self.selected = bool(state)
 
 
     ## drive_motor:
     ## Turn the selected drive's motor on/off.
     def drive_motor(self, state):
+        self._check_state()
+        if bool(state) == self.motor:
+            self.saved_cmds[Cmd.Motor] += 1
+            return
+        self.motor = None
         self._send_cmd(struct.pack("3B", Cmd.Motor, 3, int(state)))
-
-
-    ## _get_index_times:
-    ## Get index timing values for the last .read_track() command.
-    def _get_index_times(self, nr):
-        self._send_cmd(struct.pack("4B", Cmd.GetIndexTimes, 4, 0, nr))
-        x = struct.unpack("<%dI" % nr, self.ser.read(4*nr))
-        return x
+        self.motor = bool(state)
 
 
     ## update_firmware:
@@ -155,77 +422,66 @@ class Unit:
     def update_firmware(self, dat):
         self._send_cmd(struct.pack("<2BI", Cmd.Update, 6, len(dat)))
         self.ser.write(dat)
-        (ack,) = struct.unpack("B", self.ser.read(1))
+        (ack,) = struct.unpack("B", self._read(1))
         return ack
 
 
-    ## _decode_flux:
-    ## Decode the Greaseweazle data stream into a list of flux samples.
-    def _decode_flux(self, dat):
-        flux = []
-        dat_i = iter(dat)
-        try:
-            while True:
-                i = next(dat_i)
-                if i < 250:
-                    flux.append(i)
-                elif i == 255:
-                    val =  (next(dat_i) & 254) >>  1
-                    val += (next(dat_i) & 254) <<  6
-                    val += (next(dat_i) & 254) << 13
-                    val += (next(dat_i) & 254) << 20
-                    flux.append(val)
-                else:
-                    val = (i - 249) * 250
-                    val += next(dat_i) - 1
-                    flux.append(val)
-        except StopIteration:
-            pass
-        assert flux[-1] == 0
-        return flux[:-1]
-
-
-    ## _encode_flux:
-    ## Convert the given flux timings into an encoded data stream.
-    def _encode_flux(self, flux):
-        dat = bytearray()
-        for val in flux:
-            if val == 0:
-                pass
-            elif val < 250:
-                dat.append(val)
-            else:
-                high = val // 250
-                if high <= 5:
-                    dat.append(249+high)
-                    dat.append(1 + val%250)
-                else:
-                    dat.append(255)
-                    dat.append(1 | (val<<1) & 255)
-                    dat.append(1 | (val>>6) & 255)
-                    dat.append(1 | (val>>13) & 255)
-                    dat.append(1 | (val>>20) & 255)
-        dat.append(0) # End of Stream
-        return dat
-
-
     ## _read_track:
     ## Private helper which issues command requests to Greaseweazle.
+    ## The stream is decoded in chunks while it is still being received.
+    ## Returns the flux list and the index-times list.
     def _read_track(self, nr_revs):
 
-        # Request and read all flux timings for this track.
-        dat = bytearray()
-        self._send_cmd(struct.pack("3B", Cmd.ReadFlux, 3, nr_revs+1))
-        while True:
-            dat += self.ser.read(1)
-            dat += self.ser.read(self.ser.in_waiting)
-            if dat[-1] == 0:
-                break
+        # Request all flux timings for this track, and pipeline the flux
+        # status request, which the firmware queues until the flux stream
+        # is complete. Only one command may be queued behind the stream, so
+        # the index times are requested after the flux status.
+        decoder = FluxDecoder()
+        nr_idx = nr_revs + 1
+        self._send_cmd(struct.pack("3B", Cmd.ReadFlux, 3, nr_idx), wait=False)
+        self._send_cmd(struct.pack("2B", Cmd.GetFluxStatus, 2), wait=False)
+        self._get_ack()
+
+        # Read the flux stream.
+        timeout, self.ser.timeout = self.ser.timeout, self.flux_timeout
+        try:
+            dat = self._read_buf
+            buf = memoryview(dat)
+            # Start with any stream bytes which were already received.
+            pos = len(self._rx)
+            dat[:pos] = self._rx
+            end = dat.find(0, 0, pos)
+            while end < 0:
+                # Block until data arrives, then take all that is available.
+                n = max(self.ser.in_waiting, 1)
+                if pos + n > len(dat):
+                    dat = bytearray(max(pos + n, 2*len(dat)))
+                    dat[:pos] = buf[:pos]
+                    buf = memoryview(dat)
+                    self._read_buf = dat
+                n = self.ser.readinto(buf[pos:pos+n])
+                if n == 0:
+                    raise TimeoutError("Timed out reading flux")
+                end = dat.find(0, pos, pos+n)
+                pos += n
+                # Decode what we have so far while the next data arrives.
+                if end < 0 and pos >= self.decode_chunk:
+                    decoder.feed(buf[:pos])
+                    pos = 0
+            # The stream ends at the first zero byte. Anything after it is
+            # the response to the pipelined flux-status command.
+            end += 1
+            self._rx = bytearray(buf[end:pos])
+            decoder.feed(buf[:end])
+        finally:
+            self.ser.timeout = timeout
 
         # Check flux status. An exception is raised if there was an error.
-        self._send_cmd(struct.pack("2B", Cmd.GetFluxStatus, 2))
+        self._get_ack()
+        index_list = struct.unpack("<%dI" % nr_idx, self._send_cmd(
+            struct.pack("4B", Cmd.GetIndexTimes, 4, 0, nr_idx), 4*nr_idx))
 
-        return dat
+        return decoder.finish(), index_list
 
 
     ## read_track:
@@ -235,52 +491,71 @@ class Unit:
         retry = 0
         while True:
             try:
-                dat = self._read_track(nr_revs)
+                flux_list, index_list = self._read_track(nr_revs)
             except CmdError as error:
                 # An error occurred. We may retry on transient overflows.
                 if error.code == Ack.FluxOverflow and retry < nr_retries:
                     retry += 1
                 else:
                     raise error
+            except:
+                # Any other failure (eg. a timeout) leaves pipelined
+                # commands and stream data outstanding: Start afresh.
+                self.reset()
+                raise
             else:
                 # Success!
                 break
 
-        # Decode the flux list and read the index-times list.
-        flux_list = self._decode_flux(dat)
-        index_list = self._get_index_times(nr_revs+1)
-
-        # Clip the initial partial revolution.
-        to_index = index_list[0]
-        for i in range(len(flux_list)):
-            to_index -= flux_list[i]
-            if to_index < 0:
-                flux_list[i] = -to_index
-                flux_list = flux_list[i:]
-                break
-        if to_index >= 0:
-            # We ran out of flux.
-            flux_list = []
-        index_list = index_list[1:]
-
-        # Success: Return the requested full index-to-index revolutions.
-        return Flux(index_list, flux_list, self.sample_freq)
+        # Success: Return the requested full index-to-index revolutions,
+        # clipping the initial partial revolution.
+        flux = Flux(index_list[1:], flux_list, self.sample_freq)
+        flux.clip(index_list[0])
+        return flux
 
 
     ## write_track:
     ## Write the given flux stream to the current track via Greaseweazle.
+    ## Returns the encoded data stream as a list of chunks, which may be
+    ## passed to write_stream.
     def write_track(self, flux_list, nr_retries=5):
+        # The data stream is encoded in chunks, each of which is sent as
+        # soon as it is ready.
+        encoder = self._encoder.encode_chunks(flux_list, self.encode_chunk)
+        return self._write_track(encoder, nr_retries)
 
-        # Create encoded data stream.
-        dat = self._encode_flux(flux_list)
-        
+
+    ## write_stream:
+    ## Write an already encoded data stream (bytes-like, or a list of
+    ## chunks) to the current track.
+    def write_stream(self, dat, nr_retries=5):
+        if not isinstance(dat, list):
+            dat = [dat]
+        self._write_track(iter(dat), nr_retries)
+
+
+    ## _write_track:
+    ## Private helper which writes the chunks of an encoded data stream.
+    ## Chunks are kept in case we need to retry, and are returned.
+    def _write_track(self, encoder, nr_retries):
+
+        chunks = []
         retry = 0
         while True:
             try:
-                # Write the flux stream to the track via Greaseweazle.
-                self._send_cmd(struct.pack("<2BIB", Cmd.WriteFlux, 7, 0, 1))
-                self.ser.write(dat)
-                self.ser.read(1) # Sync with Greaseweazle
+                # Write the flux stream to the track via Greaseweazle. The
+                # first chunk is prepared while the command is acknowledged.
+                self._send_cmd(struct.pack("<2BIB", Cmd.WriteFlux, 7, 0, 1),
+                               wait=False)
+                if not chunks:
+                    chunks.append(next(encoder))
+                self._get_ack()
+                for dat in chunks:
+                    self.ser.write(dat)
+                for dat in encoder:
+                    chunks.append(dat)
+                    self.ser.write(dat)
+                self._read(1) # Sync with Greaseweazle
                 self._send_cmd(struct.pack("2B", Cmd.GetFluxStatus, 2))
             except CmdError as error:
                 # An error occurred. We may retry on transient underflows.
@@ -288,10 +563,16 @@ class Unit:
                     retry += 1
                 else:
                     raise error
+            except:
+                # Any other failure leaves the stream part-written.
+                self.reset()
+                raise
             else:
                 # Success!
                 break
 
+        return chunks
+
 
     ##
     ## Delay-property public getters and setters:
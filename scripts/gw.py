@@ -12,7 +12,8 @@
 import sys
 import importlib
 
-actions = [ 'read', 'write', 'delays', 'update' ]
+actions = [ 'read', 'write', 'duplicate', 'delays', 'update',
+            'pllbench', 'stress' ]
 argv = sys.argv
 
 if len(argv) < 2 or argv[1] not in actions:
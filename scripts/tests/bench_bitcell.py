@@ -0,0 +1,67 @@
+# tests/bench_bitcell.py
+#
+# Benchmark the peak memory (RSS) of decoding a whole disk into bitcells,
+# with and without bitcell times, keeping every decoded track as a whole-
+# disk analysis would. Each mode runs in its own process. Run from the
+# scripts directory:
+#  python3 tests/bench_bitcell.py [tracks]
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import os, sys, time, resource, subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from greaseweazle.flux import Flux
+from greaseweazle.bitcell import Bitcell
+import streams
+
+# peak_rss:
+# Returns the peak resident set size of this process, in MB.
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# decode_disk:
+# Decodes @nr_tracks tracks of 2-revolution DD flux, and returns the
+# increase in peak RSS and the time taken.
+def decode_disk(nr_tracks, collect_times):
+    rng = np.random.default_rng(0)
+    base = peak_rss()
+    t = time.perf_counter()
+    disk = []
+    for i in range(nr_tracks):
+        flux = Flux([14400000] * 2, streams.mfm_flux(rng, 2e-6, revs=2),
+                    72000000)
+        b = Bitcell()
+        b.collect_times = collect_times
+        b.read_flux(flux)
+        disk.append(b)
+        del flux
+    return peak_rss() - base, time.perf_counter() - t
+
+
+def main(argv):
+    if len(argv) > 2:
+        rss, secs = decode_disk(int(argv[1]), argv[2] == 'times')
+        print("%.1f %.2f" % (rss, secs))
+        return
+    nr_tracks = argv[1] if len(argv) > 1 else '160'
+    print("%s tracks of 2-revolution DD flux:" % nr_tracks)
+    for mode in ('times', 'bits'):
+        out = subprocess.run([sys.executable, argv[0], nr_tracks, mode],
+                             check=True, capture_output=True, text=True)
+        rss, secs = out.stdout.split()
+        print(" collect_times=%s: peak RSS +%sMB, %ss"
+              % (mode == 'times', rss, secs))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+# Local variables:
+# python-indent: 4
+# End:
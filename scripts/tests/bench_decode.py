@@ -0,0 +1,54 @@
+# tests/bench_decode.py
+#
+# Benchmark the flux stream decoder against the reference decoder, on
+# synthetic 3-revolution MFM streams. Run from the scripts directory:
+#  python3 tests/bench_decode.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import os, sys, time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from greaseweazle.usb import FluxDecoder
+import reference, streams
+
+# best_of:
+# Returns the result and the shortest time (seconds) of @n calls of @fn.
+def best_of(n, fn, *args):
+    best = None
+    for i in range(n):
+        t = time.perf_counter()
+        result = fn(*args)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return result, best
+
+
+def decode(dat):
+    decoder = FluxDecoder()
+    for i in range(0, len(dat), 16384):
+        decoder.feed(dat[i:i+16384])
+    return decoder.finish()
+
+
+def main():
+    rng = np.random.default_rng(0)
+    for name, clock in (('HD', 1e-6), ('DD', 2e-6)):
+        dat = streams.mfm_stream(rng, clock)
+        ref, t_ref = best_of(3, reference.decode_flux, dat)
+        new, t_new = best_of(3, decode, dat)
+        assert new.tolist() == ref
+        print("%s, %ukB stream: reference %.1fms, FluxDecoder %.1fms"
+              % (name, len(dat)//1000, t_ref*1000, t_new*1000))
+
+
+if __name__ == "__main__":
+    main()
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -0,0 +1,43 @@
+# tests/bench_resample.py
+#
+# Benchmark Flux.resample against the reference carried-remainder loop on
+# a long track, and report each one's drift from the exact scaled track
+# time. Run from the scripts directory:
+#  python3 tests/bench_resample.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import os, sys, time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from greaseweazle.flux import Flux
+import reference, streams
+
+def main():
+    rng = np.random.default_rng(0)
+    flux = Flux([], streams.mfm_flux(rng, 1e-6, revs=75), 72000000)
+    exact = int(flux.list.sum(dtype=np.int64))
+    print("%u samples" % len(flux.list))
+    for factor in (40/72, 72/40, 0.98765):
+        t = time.perf_counter()
+        ref = reference.resample(flux.list.tolist(), factor)
+        t_ref = time.perf_counter() - t
+        t = time.perf_counter()
+        new = flux.resample(factor)
+        t_new = time.perf_counter() - t
+        print("factor %.5f: reference %.0fms (drift %.1f ticks), "
+              "resample %.0fms (drift %.1f ticks)"
+              % (factor, t_ref*1000, sum(ref) - exact*factor,
+                 t_new*1000, int(new.sum(dtype=np.int64)) - exact*factor))
+
+
+if __name__ == "__main__":
+    main()
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -0,0 +1,66 @@
+# tests/bench_scp.py
+#
+# Benchmark SCP.get_track against the reference SCP track decoder, in MB/s
+# of track data. Uses the given SCP image files, or else a synthetic image
+# of 5-revolution HD tracks. Run from the scripts directory:
+#  python3 tests/bench_scp.py [file.scp ...]
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import os, sys, time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from greaseweazle.flux import Flux
+from greaseweazle.image.scp import SCP
+import reference, streams
+
+# synthetic_image:
+# Returns an SCP image of @nr tracks of random HD flux.
+def synthetic_image(nr):
+    rng = np.random.default_rng(0)
+    image = SCP(0, 2)
+    for i in range(nr):
+        flux = streams.mfm_flux(rng, 1e-6, revs=5)
+        index_list = [14400000] * 5
+        image.append_track(Flux(index_list, flux, 72000000))
+    return image.get_image()
+
+
+def bench(name, dat):
+    image = SCP.from_file(dat)
+    nr_tracks = len(image.track_list)
+    t = time.perf_counter()
+    n, c = image.nr_sides, image.start_cyl
+    new = [image.get_track(c + i//n, i%n) for i in range(nr_tracks)]
+    t_new = time.perf_counter() - t
+    # The reference decodes the track data parsed by get_track.
+    cells = [dat for _, dat in image.track_list if dat]
+    t = time.perf_counter()
+    ref = [reference.decode_scp(dat) for dat in cells]
+    t_ref = time.perf_counter() - t
+    assert [f.list.tolist() for f in new if f] == ref
+    mb = sum(len(dat) for dat in cells) / 1e6
+    print("%s: %u tracks, %.1fMB of track data" % (name, nr_tracks, mb))
+    print(" reference %.2fs (%.1f MB/s), get_track %.2fs (%.1f MB/s)"
+          % (t_ref, mb / t_ref, t_new, mb / t_new))
+
+
+def main(argv):
+    if len(argv) > 1:
+        for name in argv[1:]:
+            with open(name, "rb") as f:
+                bench(name, f.read())
+    else:
+        bench("synthetic", synthetic_image(40))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -0,0 +1,150 @@
+# tests/reference.py
+#
+# Reference implementations, for checking and benchmarking the vectorised
+# code which replaced them. These are the original straightforward loops.
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import struct
+
+# decode_flux:
+# Decode a Greaseweazle data stream into a list of flux samples.
+def decode_flux(dat):
+    flux = []
+    dat_i = iter(dat)
+    try:
+        while True:
+            i = next(dat_i)
+            if i < 250:
+                flux.append(i)
+            elif i == 255:
+                val =  (next(dat_i) & 254) >>  1
+                val += (next(dat_i) & 254) <<  6
+                val += (next(dat_i) & 254) << 13
+                val += (next(dat_i) & 254) << 20
+                flux.append(val)
+            else:
+                val = (i - 249) * 250
+                val += next(dat_i) - 1
+                flux.append(val)
+    except StopIteration:
+        pass
+    assert flux[-1] == 0
+    return flux[:-1]
+
+
+# encode_flux:
+# Convert flux timings into a Greaseweazle data stream.
+def encode_flux(flux):
+    dat = bytearray()
+    for val in flux:
+        if val == 0:
+            pass
+        elif val < 250:
+            dat.append(val)
+        else:
+            high = val // 250
+            if high <= 5:
+                dat.append(249+high)
+                dat.append(1 + val%250)
+            else:
+                dat.append(255)
+                dat.append(1 | (val<<1) & 255)
+                dat.append(1 | (val>>6) & 255)
+                dat.append(1 | (val>>13) & 255)
+                dat.append(1 | (val>>20) & 255)
+    dat.append(0) # End of Stream
+    return dat
+
+
+# resample:
+# Scale flux samples by @factor, carrying each rounding remainder into the
+# next sample.
+def resample(flux_list, factor):
+    rem = 0.0
+    out = []
+    for x in flux_list:
+        y = x * factor + rem
+        val = int(round(y))
+        rem = y - val
+        out.append(val)
+    return out
+
+
+# decode_scp:
+# Decode SCP track data (16-bit big-endian cells) into a list of flux times.
+def decode_scp(dat):
+    flux_list = []
+    val = 0
+    for i in range(0, len(dat), 2):
+        x = dat[i]*256 + dat[i+1]
+        if x == 0:
+            val += 65536
+            continue
+        flux_list.append(val + x)
+        val = 0
+    return flux_list
+
+
+# encode_scp:
+# Convert a Flux object into SCP track number @trknr, returning the Track
+# Data Header and the track data.
+def encode_scp(flux, trknr, sample_freq=40000000):
+    nr_revs = len(flux.index_list)
+    factor = sample_freq / flux.sample_freq
+
+    tdh = struct.pack("<3sB", b"TRK", trknr)
+    dat = bytearray()
+
+    len_at_index = rev = 0
+    to_index = flux.index_list[0]
+    rem = 0.0
+
+    for x in flux.list:
+
+        # Does the next flux interval cross the index mark?
+        while to_index < x:
+            # Append to the TDH for the previous full revolution
+            tdh += struct.pack("<III",
+                               int(round(flux.index_list[rev]*factor)),
+                               (len(dat) - len_at_index) // 2,
+                               4 + nr_revs*12 + len_at_index)
+            # Set up for the next revolution
+            len_at_index = len(dat)
+            rev += 1
+            if rev >= nr_revs:
+                # We're done: We simply discard any surplus flux samples
+                return tdh, dat
+            to_index += flux.index_list[rev]
+
+        # Process the current flux sample into SCP "bitcell" format
+        to_index -= x
+        y = x * factor + rem
+        val = int(round(y))
+        if (val & 65535) == 0:
+            val += 1
+        rem = y - val
+        while val >= 65536:
+            dat.append(0)
+            dat.append(0)
+            val -= 65536
+        dat.append(val>>8)
+        dat.append(val&255)
+
+    # Header for last track(s) in case we ran out of flux timings.
+    while rev < nr_revs:
+        tdh += struct.pack("<III",
+                           int(round(flux.index_list[rev]*factor)),
+                           (len(dat) - len_at_index) // 2,
+                           4 + nr_revs*12 + len_at_index)
+        len_at_index = len(dat)
+        rev += 1
+
+    return tdh, dat
+
+# Local variables:
+# python-indent: 4
+# End:
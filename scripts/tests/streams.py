@@ -0,0 +1,44 @@
+# tests/streams.py
+#
+# Synthetic Greaseweazle data streams, for tests and benchmarks.
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import numpy as np
+
+from greaseweazle.usb import FluxEncoder
+
+# mfm_flux:
+# Returns @revs revolutions of random MFM flux (2, 3 or 4 bitcells per
+# interval, with jitter) at 300rpm, for a bitcell of @clock seconds at the
+# given sample frequency.
+def mfm_flux(rng, clock, revs=3, sample_freq=72000000):
+    cell = clock * sample_freq
+    n = int(revs * 0.2 / (3 * clock))
+    flux = rng.integers(2, 5, n) * cell + rng.normal(0, cell/20, n)
+    return np.rint(flux).astype(np.uint32)
+
+
+# mfm_stream:
+# Returns the encoded data stream of mfm_flux().
+def mfm_stream(rng, clock, revs=3, sample_freq=72000000):
+    return bytes(FluxEncoder().encode(mfm_flux(rng, clock, revs,
+                                               sample_freq)))
+
+
+# random_stream:
+# Returns a stream of @n random bytes, rich in opcodes, followed by an End
+# of Stream marker which cannot be mistaken for the operand of an opcode.
+def random_stream(rng, n):
+    dat = rng.integers(0, 256, n, dtype=np.uint8)
+    op = rng.random(n) < 0.3
+    dat[op] = rng.integers(250, 256, int(op.sum()))
+    dat[dat == 0] = 1
+    return dat.tobytes() + bytes([1] * 5 + [0])
+
+# Local variables:
+# python-indent: 4
+# End:
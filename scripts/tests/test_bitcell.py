@@ -0,0 +1,86 @@
+# tests/test_bitcell.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import unittest
+from array import array
+import numpy as np
+
+from greaseweazle.flux import Flux
+from greaseweazle import bitcell
+import streams
+
+engines = (bitcell.PLL, bitcell.FixedClock, bitcell.AdaptivePLL)
+
+class TestEngines(unittest.TestCase):
+
+    def decode(self, engine, flux):
+        b = bitcell.Bitcell()
+        b.engine = engine()
+        b.read_flux(flux)
+        return [bits.to01() for bits, _ in b.revolution_list]
+
+    def test_no_flux(self):
+        flux = Flux([14400000], [], 72000000)
+        for engine in engines:
+            self.assertEqual(self.decode(engine, flux), [''])
+
+    def test_constant_flux(self):
+        # Every interval is 2 bitcells: The clock is measured exactly.
+        flux = Flux([72000], [288] * 250, 72000000)
+        clock = bitcell.AdaptivePLL().estimate_clock(flux, None)
+        self.assertAlmostEqual(clock, 2e-6)
+        for engine in engines:
+            bits = self.decode(engine, flux)[0]
+            self.assertEqual(bits[:100], '01' * 50)
+
+    def test_collect_times(self):
+        # Bits are the same with and without bitcell times, which are
+        # float32 arrays (one per bitcell) or else None.
+        rng = np.random.default_rng(9)
+        flux = Flux([14400000] * 2, streams.mfm_flux(rng, 2e-6, revs=2),
+                    72000000)
+        for engine in engines:
+            result = []
+            for collect_times in (True, False):
+                b = bitcell.Bitcell()
+                b.engine, b.collect_times = engine(), collect_times
+                b.read_flux(flux)
+                result.append(b.revolution_list)
+            with_times, without_times = result
+            self.assertEqual([bits for bits, _ in with_times],
+                             [bits for bits, _ in without_times])
+            for bits, times in with_times:
+                self.assertIsInstance(times, array)
+                self.assertEqual(times.typecode, 'f')
+                self.assertEqual(len(times), len(bits))
+            for _, times in without_times:
+                self.assertIsNone(times)
+
+class TestReadFluxList(unittest.TestCase):
+
+    def test_workers(self):
+        # Parallel decode matches serial decode, including an empty track
+        # (which shares a minimum-sized memory block).
+        rng = np.random.default_rng(11)
+        flux_list = [Flux([14400000] * 2, streams.mfm_flux(rng, c, revs=2),
+                          72000000) for c in (2e-6, 4e-6)]
+        flux_list.insert(1, Flux([14400000], [], 72000000))
+        for track_list in (flux_list, flux_list[1:2]):
+            result = bitcell.read_flux_list(track_list, workers=2)
+            self.assertEqual(len(result), len(track_list))
+            for b, flux in zip(result, track_list):
+                ref = bitcell.Bitcell()
+                ref.read_flux(flux)
+                self.assertEqual(b.revolution_list, ref.revolution_list)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -0,0 +1,70 @@
+# tests/test_cache.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import os, time, tempfile, unittest
+
+from greaseweazle.cache import StreamCache
+
+class TestStreamCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def put(self, cache, key, dat):
+        cache.put(key, dat)
+        time.sleep(0.01) # Distinct use times
+
+    def test_lru(self):
+        cache = StreamCache(self.path, 250)
+        for key in ('a', 'b', 'c'):
+            self.put(cache, key, bytes(100))
+        # 'a' is least recently used.
+        self.assertEqual(cache.size, 200)
+        self.assertIsNone(cache.get('a'))
+        # Using 'b' makes 'c' the least recently used.
+        self.assertIsNotNone(cache.get('b'))
+        time.sleep(0.01)
+        self.put(cache, 'd', bytes(100))
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get('b'), bytes(100))
+        self.assertEqual(cache.get('d'), bytes(100))
+        self.assertEqual(cache.size, 200)
+        self.assertEqual(len(os.listdir(self.path)), 2)
+
+    def test_reindex(self):
+        cache = StreamCache(self.path, 1000)
+        self.put(cache, ('x', 1), b'123')
+        self.put(cache, ('x', 2), b'4567')
+        cache = StreamCache(self.path, 1000)
+        self.assertEqual(cache.size, 7)
+        self.assertEqual(cache.get(('x', 2)), b'4567')
+        self.assertEqual(cache.get(('x', 1)), b'123')
+        # Use times survive: ('x', 2) is now least recently used.
+        time.sleep(0.01)
+        cache = StreamCache(self.path, 5)
+        self.put(cache, ('x', 3), b'')
+        self.assertIsNone(cache.get(('x', 2)))
+        self.assertEqual(cache.get(('x', 1)), b'123')
+
+    def test_empty_entry(self):
+        cache = StreamCache(self.path, 1000)
+        cache.put('missing track', bytes())
+        self.assertEqual(cache.get('missing track'), bytes())
+        self.assertIsNone(cache.get('unknown'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -0,0 +1,96 @@
+# tests/test_flux.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import unittest
+import numpy as np
+
+from greaseweazle.flux import Flux
+import reference, streams
+
+class TestClip(unittest.TestCase):
+
+    def test_clip(self):
+        flux = Flux([10], [3, 4, 5, 6], 1000)
+        flux.clip(5)
+        self.assertEqual(flux.list.tolist(), [2, 5, 6])
+        self.assertEqual(flux.sample_at(7), 2)
+
+    def test_clip_caller_array(self):
+        # Clipping does not modify the array the Flux was created from.
+        a = np.array([3, 4, 5, 6], dtype=np.uint32)
+        flux = Flux([10], a, 1000)
+        flux.clip(5)
+        self.assertEqual(flux.list.tolist(), [2, 5, 6])
+        self.assertEqual(a.tolist(), [3, 4, 5, 6])
+
+    def test_clip_at_sample_end(self):
+        flux = Flux([10], [3, 4, 5], 1000)
+        flux.clip(7)
+        self.assertEqual(flux.list.tolist(), [5])
+
+    def test_clip_all(self):
+        flux = Flux([10], [3, 4], 1000)
+        flux.clip(7)
+        self.assertEqual(flux.list.tolist(), [])
+
+
+
+class TestRevolution(unittest.TestCase):
+
+    def test_revolution(self):
+        # Revolutions of 10 ticks: The sample crossing each index mark
+        # belongs to the revolution in which it ends.
+        flux = Flux([10, 10, 10], [4, 4, 4, 4, 2, 5, 5, 3], 1000)
+        self.assertEqual(flux.revolution(0).tolist(), [4, 4])
+        self.assertEqual(flux.revolution(1).tolist(), [4, 4, 2])
+        self.assertEqual(flux.revolution(2).tolist(), [5, 5])
+
+    def test_view(self):
+        flux = Flux([10, 10], [4, 4, 4, 4, 4], 1000)
+        rev = flux.revolution(1)
+        self.assertFalse(rev.flags.owndata)
+        self.assertTrue(np.shares_memory(rev, flux.list))
+        rev[0] = 7
+        self.assertEqual(flux.list[2], 7)
+
+
+class TestResample(unittest.TestCase):
+
+    # A long track: over 3 million samples (50 revolutions of HD flux).
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(7)
+        cls.flux = Flux([], streams.mfm_flux(rng, 1e-6, revs=50), 72000000)
+        cls.total = int(cls.flux.list.sum(dtype=np.int64))
+
+    # check:
+    # Resampled flux must add up to the exactly rounded scaled total, and
+    # every sample boundary must be within one tick of the reference.
+    def check(self, factor):
+        new = self.flux.resample(factor)
+        ref = np.array(reference.resample(self.flux.list.tolist(), factor))
+        self.assertEqual(int(new.sum(dtype=np.int64)),
+                         round(self.total * factor))
+        drift = np.cumsum(new, dtype=np.int64) - np.cumsum(ref)
+        self.assertLessEqual(int(np.abs(drift).max()), 1)
+        return new, ref
+
+    def test_sample_freq(self):
+        for factor in (40/72, 72/40):
+            new, ref = self.check(factor)
+            self.assertEqual(new.tolist(), ref.tolist())
+
+    def test_speed_adjust(self):
+        self.check(0.98765)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -0,0 +1,53 @@
+# tests/test_read.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import os, argparse, tempfile, unittest
+
+from greaseweazle import usb as USB
+from greaseweazle.sim import SimPort
+from greaseweazle.image.scp import SCP
+from greaseweazle.tools import read
+
+class TestReadToImage(unittest.TestCase):
+
+    def read(self, name, scyl, ecyl):
+        usb = USB.Unit(SimPort())
+        usb.drive_select(True)
+        usb.drive_motor(True)
+        args = argparse.Namespace(file=name, scyl=scyl, ecyl=ecyl,
+                                  nr_sides=2, revs=1)
+        read.read_to_image(usb, args)
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, "disk.scp")
+            self.read(name, 0, 1)
+            with open(name, "rb") as f:
+                image = SCP.from_file(f.read())
+            self.assertTrue(image.checksum_ok())
+            self.assertEqual(len(image.track_list), 4)
+            self.assertEqual(os.listdir(d), ["disk.scp"])
+
+    def test_failed_read(self):
+        # A failed read leaves any existing image alone.
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, "disk.scp")
+            with open(name, "wb") as f:
+                f.write(b"existing")
+            with self.assertRaises(USB.CmdError):
+                self.read(name, 85, 86)
+            with open(name, "rb") as f:
+                self.assertEqual(f.read(), b"existing")
+            self.assertEqual(os.listdir(d), ["disk.scp"])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# Local variables:
+# python-indent: 4
+# End:
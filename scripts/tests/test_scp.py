@@ -0,0 +1,69 @@
+# tests/test_scp.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import unittest
+import numpy as np
+
+from greaseweazle.flux import Flux
+from greaseweazle.image.scp import SCP
+import reference
+
+class TestSCP(unittest.TestCase):
+
+    # image:
+    # Returns an SCP image of random 40MHz tracks, including long intervals
+    # which need one or more overflow cells.
+    def image(self, nr_tracks=4, nr_revs=2):
+        rng = np.random.default_rng(11)
+        image = SCP(0, 2)
+        for i in range(nr_tracks):
+            flux = rng.integers(40, 200, 20000 * nr_revs)
+            flux[::997] = rng.integers(65000, 300000, len(flux[::997]))
+            flux[::1999] = 65536 * rng.integers(1, 4, len(flux[::1999]))
+            rev = int(flux.sum()) // nr_revs
+            image.append_track(Flux([rev] * nr_revs, flux, SCP.sample_freq))
+        return image
+
+    def test_get_track(self):
+        image = SCP.from_file(self.image().get_image())
+        for cyl, side in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            flux = image.get_track(cyl, side)
+            _, dat = image.track_list[cyl*2 + side]
+            self.assertEqual(flux.list.tolist(), reference.decode_scp(dat))
+
+    def test_append_track(self):
+        # Track bytes match the original per-sample encoder. Samples which
+        # are multiples of 65536 need multi-cell overflows and a zero-cell
+        # adjustment, which cascades through following samples of 65537.
+        rng = np.random.default_rng(12)
+        cascade = [65536, 65537, 65537, 65537, 131072, 131073, 65537, 100]
+        tracks = []
+        for sample_freq in (SCP.sample_freq, 72000000):
+            for nr_revs in (1, 2, 3):
+                flux = rng.integers(40, 200, 20000 * nr_revs)
+                flux[::997] = rng.integers(65000, 300000, len(flux[::997]))
+                for i in range(500, len(flux) - len(cascade), 1501):
+                    flux[i:i+len(cascade)] = cascade
+                rev = int(flux.sum()) // nr_revs
+                tracks.append(Flux([rev] * nr_revs, flux, sample_freq))
+        # Flux which runs out before the final index.
+        tracks.append(Flux([rev] * 5, flux, sample_freq))
+        for flux in tracks:
+            image = SCP(0, 2)
+            image.append_track(flux)
+            tdh, dat = image.track_list[0]
+            ref_tdh, ref_dat = reference.encode_scp(flux, 0)
+            self.assertEqual(tdh, ref_tdh)
+            self.assertEqual(bytes(dat), bytes(ref_dat))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# Local variables:
+# python-indent: 4
+# End:
@@ -0,0 +1,249 @@
+# tests/test_usb.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import time, unittest
+import numpy as np
+
+from greaseweazle import usb as USB
+from greaseweazle.usb import FluxDecoder, FluxEncoder
+from greaseweazle.sim import SimPort
+import reference, streams
+
+class TestFluxDecoder(unittest.TestCase):
+
+    # decode:
+    # Decodes the stream with FluxDecoder, fed in random-sized chunks.
+    def decode(self, rng, dat):
+        decoder = FluxDecoder()
+        pos = 0
+        while pos < len(dat):
+            n = int(rng.integers(1, 64 if rng.random() < 0.5 else 8192))
+            decoder.feed(dat[pos:pos+n])
+            pos += n
+        return decoder.finish().tolist()
+
+    def test_random_streams(self):
+        rng = np.random.default_rng(1)
+        for i in range(200):
+            dat = streams.random_stream(rng, int(rng.integers(0, 20000)))
+            self.assertEqual(self.decode(rng, dat),
+                             reference.decode_flux(dat))
+
+    def test_mfm_streams(self):
+        rng = np.random.default_rng(2)
+        for clock in (1e-6, 2e-6):
+            dat = streams.mfm_stream(rng, clock)
+            self.assertEqual(self.decode(rng, dat),
+                             reference.decode_flux(dat))
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(3)
+        flux = rng.integers(1, 1 << 28, 50000).astype(np.uint32)
+        flux[::3] = flux[::3] % 1600 + 1
+        dat = bytes(FluxEncoder().encode(flux))
+        self.assertEqual(self.decode(rng, dat), flux.tolist())
+
+
+
+class TestFluxEncoder(unittest.TestCase):
+
+    def test_boundaries(self):
+        flux = [0, 1, 249, 250, 251, 499, 500, 1499, 1500, 1501, 0, 0,
+                (1 << 28) - 1, 0]
+        self.assertEqual(bytes(FluxEncoder().encode(flux)),
+                         bytes(reference.encode_flux(flux)))
+
+    def test_random(self):
+        rng = np.random.default_rng(4)
+        flux = rng.integers(0, 3000, 100000)
+        flux[::7] = rng.integers(0, 1 << 28, len(flux[::7]))
+        encoder = FluxEncoder()
+        ref = bytes(reference.encode_flux(flux.tolist()))
+        self.assertEqual(bytes(encoder.encode(flux)), ref)
+        chunks = encoder.encode_chunks(flux, 8192)
+        self.assertEqual(b"".join(chunks), ref)
+
+    def test_empty(self):
+        for flux in ([], [0, 0]):
+            self.assertEqual(bytes(FluxEncoder().encode(flux)), bytes(1))
+
+
+class TestSimPort(unittest.TestCase):
+
+    def test_one_command_per_packet(self):
+        # The rest of a packet after a command is discarded.
+        port = SimPort()
+        port.write(bytes([USB.Cmd.GetFluxStatus, 2] * 2))
+        self.assertEqual(port.read(2), bytes([USB.Cmd.GetFluxStatus, 0]))
+        self.assertEqual(port.in_waiting, 0)
+
+    def test_command_held_during_stream(self):
+        # A command sent during a flux stream is processed after it.
+        port = SimPort()
+        for cmd in ((USB.Cmd.Select, 3, 1), (USB.Cmd.Motor, 3, 1)):
+            port.write(bytes(cmd))
+            port.read(2)
+        port.write(bytes([USB.Cmd.ReadFlux, 3, 2]))
+        port.write(bytes([USB.Cmd.Side, 3, 1]))
+        self.assertEqual(port.side, 0)
+        self.assertEqual(port.read(2), bytes([USB.Cmd.ReadFlux, 0]))
+        stream = bytearray()
+        while not stream or stream[-1] != 0:
+            stream += port.read(1)
+        self.assertEqual(port.side, 1)
+        self.assertEqual(port.read(2), bytes([USB.Cmd.Side, 0]))
+
+    def test_commands_gathered_during_stream(self):
+        # Commands sent during a flux stream are gathered into one buffer,
+        # and all but the first are lost.
+        port = SimPort()
+        for cmd in ((USB.Cmd.Select, 3, 1), (USB.Cmd.Motor, 3, 1)):
+            port.write(bytes(cmd))
+            port.read(2)
+        port.write(bytes([USB.Cmd.ReadFlux, 3, 2]))
+        port.write(bytes([USB.Cmd.GetFluxStatus, 2]))
+        port.write(bytes([USB.Cmd.GetIndexTimes, 4, 0, 2]))
+        self.assertEqual(port.read(2), bytes([USB.Cmd.ReadFlux, 0]))
+        stream = bytearray()
+        while not stream or stream[-1] != 0:
+            stream += port.read(1)
+        self.assertEqual(port.read(2), bytes([USB.Cmd.GetFluxStatus, 0]))
+        self.assertEqual(port.in_waiting, 0)
+
+
+class LogPort(SimPort):
+
+    def __init__(self):
+        super().__init__()
+        self.log = []
+
+    def write(self, dat):
+        self.log.append(dat[0])
+        return super().write(dat)
+
+
+class TestDriveState(unittest.TestCase):
+
+    def setUp(self):
+        self.port = LogPort()
+        self.unit = USB.Unit(self.port)
+        self.unit.drive_select(True)
+        self.unit.drive_motor(True)
+        self.unit.seek(2, 0)
+        self.unit.saved_cmds.clear()
+        self.port.log.clear()
+
+    def test_skip(self):
+        Cmd, unit = USB.Cmd, self.unit
+        unit.seek(2, 1)
+        self.assertEqual(self.port.log, [Cmd.Side])
+        unit.seek(3, 1)
+        self.assertEqual(self.port.log, [Cmd.Side, Cmd.Seek])
+        unit.seek(3, 1)
+        unit.drive_select(True)
+        unit.drive_motor(True)
+        self.assertEqual(self.port.log, [Cmd.Side, Cmd.Seek])
+        self.assertEqual(unit.saved_cmds, {Cmd.Seek: 2, Cmd.Side: 2,
+                                           Cmd.Select: 1, Cmd.Motor: 1})
+        self.assertEqual((unit.cyl, unit.side), (3, 1))
+        self.assertEqual((self.port.cyl, self.port.side), (3, 1))
+
+    def test_reset(self):
+        self.unit.reset()
+        self.unit.drive_select(True)
+        self.unit.drive_motor(True)
+        self.unit.seek(2, 0)
+        Cmd = USB.Cmd
+        self.assertEqual(self.port.log,
+                         [Cmd.Select, Cmd.Motor, Cmd.Seek, Cmd.Side])
+        self.assertEqual(sum(self.unit.saved_cmds.values()), 0)
+
+    def test_failed_seek(self):
+        with self.assertRaises(USB.CmdError):
+            self.unit.seek(90, 1)
+        self.assertIsNone(self.unit.cyl)
+        self.assertIsNone(self.unit.side)
+        self.port.log.clear()
+        self.unit.seek(2, 0)
+        self.assertEqual(self.port.log, [USB.Cmd.Seek, USB.Cmd.Side])
+
+    def test_auto_off(self):
+        # Select and motor state are forgotten well before the firmware's
+        # auto-off timeout.
+        self.unit.auto_off_delay = 100
+        self.unit.drive_select(True)
+        self.assertEqual(self.unit.saved_cmds[USB.Cmd.Select], 1)
+        time.sleep(0.06)
+        self.port.log.clear()
+        self.unit.drive_select(True)
+        self.unit.drive_motor(True)
+        self.assertEqual(self.port.log, [USB.Cmd.Select, USB.Cmd.Motor])
+        # The head position is unaffected.
+        self.unit.seek(2, 0)
+        self.assertEqual(self.port.log, [USB.Cmd.Select, USB.Cmd.Motor])
+
+
+class TestUnit(unittest.TestCase):
+
+    def read_write(self, unit):
+        unit.drive_select(True)
+        unit.drive_motor(True)
+        unit.seek(2, 1)
+        flux = unit.read_track(2)
+        unit.write_track(flux.list)
+        flux = unit.read_track(1)
+        self.assertEqual(int(flux.list.sum()), sum(flux.index_list))
+        unit.drive_motor(False)
+        unit.drive_select(False)
+        with self.assertRaises(USB.CmdError):
+            unit.read_track(1)
+
+    def test_read_pipeline_depth(self):
+        # No command is lost behind the flux stream. The port timeout
+        # turns a lost acknowledgement into a failure, rather than a hang.
+        port = SimPort()
+        port.timeout = 0.5
+        unit = USB.Unit(port)
+        unit.pipeline = True
+        unit.drive_select(True)
+        unit.drive_motor(True)
+        for i in range(3):
+            flux = unit.read_track(2)
+            self.assertEqual(len(flux.index_list), 2)
+
+    def test_pipelined(self):
+        unit = USB.Unit(SimPort())
+        unit.pipeline = True
+        self.read_write(unit)
+
+    def test_unpipelined(self):
+        unit = USB.Unit(SimPort())
+        unit.pipeline = False
+        self.read_write(unit)
+
+    def test_read_timeout(self):
+        # A stalled flux stream times out, and leaves the unit usable.
+        port = SimPort(bandwidth=10)
+        unit = USB.Unit(port)
+        unit.flux_timeout = 0.05
+        unit.drive_select(True)
+        unit.drive_motor(True)
+        with self.assertRaises(TimeoutError):
+            unit.read_track(2)
+        unit.drive_motor(False)
+        port.bandwidth = None
+        unit.drive_motor(True)
+        flux = unit.read_track(2)
+        self.assertEqual(int(flux.list.sum()), sum(flux.index_list))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# Local variables:
+# python-indent: 4
+# End:
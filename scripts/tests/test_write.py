@@ -0,0 +1,51 @@
+# tests/test_write.py
+#
+# Written & released by Keir Fraser <keir.xen@gmail.com>
+#
+# This is free and unencumbered software released into the public domain.
+# See the file COPYING for more details, or visit <http://unlicense.org>.
+
+import unittest
+import numpy as np
+
+from greaseweazle.tools.write import flux_mismatch
+
+class TestFluxMismatch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(5)
+        cls.rng = rng
+        cls.flux = rng.integers(2, 5, 100000) * 72
+
+    def jitter(self, flux):
+        return flux + self.rng.normal(0, 3, len(flux))
+
+    def test_match(self):
+        self.assertEqual(flux_mismatch(self.flux, self.jitter(self.flux)), 0)
+
+    def test_offset(self):
+        read = np.concatenate(([150, 300, 220], self.flux))
+        self.assertEqual(flux_mismatch(self.flux, self.jitter(read)), 0)
+
+    def test_glitch(self):
+        # An extra or a missing transition costs only nearby intervals,
+        # wherever it is on the track.
+        f = self.flux
+        for i in (100, 30000, 90000):
+            extra = np.concatenate((f[:i], [f[i]//2, f[i]//2], f[i+1:]))
+            missing = np.concatenate((f[:i], [f[i]+f[i+1]], f[i+2:]))
+            for read in (extra, missing):
+                self.assertLess(flux_mismatch(f, self.jitter(read)), 0.002)
+
+    def test_mismatch(self):
+        read = self.rng.integers(100, 300, len(self.flux))
+        self.assertGreater(flux_mismatch(self.flux, read), 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# Local variables:
+# python-indent: 4
+# End: